@@ -0,0 +1,275 @@
+import argparse
+import json
+import os
+import struct
+import threading
+from dataclasses import dataclass
+from typing import Any, Dict, List, Optional, Tuple
+
+import cv2
+import numpy as np
+
+
+BUNDLE_MAGIC = b"SDBUNDLE"
+BUNDLE_VERSION = 1
+BUNDLE_ALIGN = 64
+
+_PREFIX = struct.Struct("<IQQ")
+
+
+def _align(offset: int) -> int:
+    return (offset + BUNDLE_ALIGN - 1) // BUNDLE_ALIGN * BUNDLE_ALIGN
+
+
+def is_bundle(path: str) -> bool:
+    try:
+        with open(path, "rb") as f:
+            return f.read(len(BUNDLE_MAGIC)) == BUNDLE_MAGIC
+    except OSError:
+        return False
+
+
+@dataclass
+class Bundle:
+    path: str
+    header: Dict[str, Any]
+    arrays: Dict[str, np.ndarray]
+
+    def scene_rules(self) -> List[Dict[str, Any]]:
+        return [self._attach(rule) for rule in self.header.get("scene_rules", [])]
+
+    def _attach(self, rule: Dict[str, Any]) -> Dict[str, Any]:
+        # Template rules at any depth carry "template_key"; composite children sit under
+        # "rules" / "rule" as in the rules JSON.
+        rule = dict(rule)
+        key = rule.pop("template_key", None)
+        if key is not None:
+            rule["template_image"] = self.arrays[key]
+        if rule.get("rules"):
+            rule["rules"] = [self._attach(child) for child in rule["rules"]]
+        if rule.get("rule"):
+            rule["rule"] = self._attach(rule["rule"])
+        return rule
+
+    def transitions(self) -> Dict[str, List[str]]:
+        return dict(self.header.get("transitions", {}))
+
+    def templates(self) -> List[Dict[str, Any]]:
+        templates = []
+        for entry in self.header.get("templates", []):
+            item = {k: v for k, v in entry.items() if k not in ("image_key", "gray_key")}
+            item["image"] = self.arrays[entry["image_key"]]
+            item["gray"] = self.arrays[entry["gray_key"]]
+            templates.append(item)
+        return templates
+
+
+def write_bundle(path: str, header: Dict[str, Any], arrays: Dict[str, np.ndarray]) -> None:
+    entries: Dict[str, Dict[str, Any]] = {}
+    blobs: List[Tuple[int, np.ndarray]] = []
+    offset = 0
+    for key, array in arrays.items():
+        array = np.ascontiguousarray(array)
+        offset = _align(offset)
+        entries[key] = {"offset": offset, "shape": list(array.shape), "dtype": array.dtype.str}
+        blobs.append((offset, array))
+        offset += array.nbytes
+    raw = json.dumps(dict(header, arrays=entries)).encode("utf-8")
+    data_start = _align(len(BUNDLE_MAGIC) + _PREFIX.size + len(raw))
+
+    tmp_path = path + ".tmp"
+    with open(tmp_path, "wb") as f:
+        f.write(BUNDLE_MAGIC)
+        f.write(_PREFIX.pack(BUNDLE_VERSION, len(raw), data_start))
+        f.write(raw)
+        for blob_offset, array in blobs:
+            f.seek(data_start + blob_offset)
+            f.write(array.tobytes())
+        f.truncate(data_start + _align(offset))
+    os.replace(tmp_path, path)
+
+
+_open_bundles: Dict[Tuple[str, int, int], Bundle] = {}
+_open_lock = threading.Lock()
+
+
+def read_bundle(path: str) -> Bundle:
+    stat = os.stat(path)
+    key = (os.path.abspath(path), stat.st_mtime_ns, stat.st_size)
+    with _open_lock:
+        bundle = _open_bundles.get(key)
+        if bundle is not None:
+            return bundle
+
+    with open(path, "rb") as f:
+        if f.read(len(BUNDLE_MAGIC)) != BUNDLE_MAGIC:
+            raise ValueError(f"not a somedemo bundle: {path}")
+        version, header_len, data_start = _PREFIX.unpack(f.read(_PREFIX.size))
+        if version != BUNDLE_VERSION:
+            raise ValueError(f"unsupported bundle version {version}: {path}")
+        header = json.loads(f.read(header_len).decode("utf-8"))
+
+    # Copy-on-write mapping: arrays are zero-copy, writable views shared between processes.
+    buffer = np.memmap(path, dtype=np.uint8, mode="c")
+    arrays = {}
+    for name, entry in header.get("arrays", {}).items():
+        dtype = np.dtype(entry["dtype"])
+        shape = tuple(entry["shape"])
+        start = data_start + entry["offset"]
+        nbytes = int(np.prod(shape)) * dtype.itemsize
+        arrays[name] = np.asarray(buffer[start : start + nbytes]).view(dtype).reshape(shape)
+
+    bundle = Bundle(path=path, header=header, arrays=arrays)
+    with _open_lock:
+        for stale in [k for k in _open_bundles if k[0] == key[0]]:
+            del _open_bundles[stale]
+        _open_bundles[key] = bundle
+    return bundle
+
+
+def build_bundle(
+    output_path: str,
+    rules_path: Optional[str] = None,
+    base_dir: Optional[str] = None,
+    templates_json: Optional[str] = None,
+    program_templates: Optional[List[str]] = None,
+    local_templates: Optional[List[str]] = None,
+) -> Dict[str, int]:
+    # Imported here because the loaders in these modules read bundles through this one.
+    from somedemo.scene_matcher import (
+        compile_scene_rules,
+        load_scene_rules,
+        load_scene_transitions,
+        resolve_rule_template,
+    )
+    from somedemo.template_cache import load_image
+    from somedemo.template_matcher import TemplateMatcher
+
+    header: Dict[str, Any] = {}
+    arrays: Dict[str, np.ndarray] = {}
+    keys_by_source: Dict[Tuple[str, int, str], str] = {}
+
+    def add_array(path: str, flags: int, color: str, image: np.ndarray) -> str:
+        # The same file decoded differently (a rule's IMREAD_UNCHANGED gray or 16-bit PNG
+        # and a template's IMREAD_COLOR copy) is stored once per decoding.
+        source = (os.path.abspath(path), flags, color)
+        key = keys_by_source.get(source)
+        if key is None:
+            key = f"a{len(arrays)}"
+            arrays[key] = image
+            keys_by_source[source] = key
+        return key
+
+    def embed_templates(rule: Dict[str, Any]) -> Dict[str, Any]:
+        rule = dict(rule)
+        if rule.get("type") == "template":
+            path = resolve_rule_template(rule, base_dir)
+            image = load_image(path, cv2.IMREAD_UNCHANGED, "bgr") if path else None
+            if image is None:
+                raise ValueError(f"rule '{rule.get('name')}' template could not be loaded")
+            rule["template_key"] = add_array(path, cv2.IMREAD_UNCHANGED, "bgr", image)
+        if rule.get("rules"):
+            rule["rules"] = [embed_templates(child) for child in rule["rules"]]
+        if rule.get("rule"):
+            rule["rule"] = embed_templates(rule["rule"])
+        return rule
+
+    if rules_path:
+        rules = load_scene_rules(rules_path)
+        compiled = compile_scene_rules(rules, base_dir=base_dir)
+        for rule in compiled.all_rules():
+            if rule.type == "template" and rule.template is None:
+                raise ValueError(f"rule '{rule.name}' template could not be loaded")
+        header["scene_rules"] = [embed_templates(rule) for rule in rules]
+        header["transitions"] = load_scene_transitions(rules_path)
+
+    templates = []
+
+    def add_template(entry: Dict[str, Any], image: np.ndarray, gray: np.ndarray) -> None:
+        entry["image_key"] = add_array(entry["path"], cv2.IMREAD_COLOR, "bgr", image)
+        entry["gray_key"] = add_array(entry["path"], cv2.IMREAD_COLOR, "gray", gray)
+        templates.append(entry)
+
+    if templates_json:
+        matcher = TemplateMatcher.load_from_json(templates_json)
+        for tmpl in matcher.templates:
+            image = tmpl["image"]
+            entry = {
+                "name": tmpl["name"],
+                "threshold": float(tmpl["threshold"]),
+                "click": dict(tmpl.get("click", {})),
+                "source": "json",
+                "meta": dict(tmpl.get("meta", {})),
+                "path": tmpl.get("path", tmpl["name"]),
+            }
+            entry.update({key: tmpl[key] for key in ("color_mode", "scale") if key in tmpl})
+            add_template(entry, image, cv2.cvtColor(image, cv2.COLOR_BGR2GRAY))
+
+    if program_templates or local_templates:
+        from somedemo.template_monitor import load_template_item
+
+        sources = [(path, "program_capture") for path in program_templates or []]
+        sources += [(path, "local_image") for path in local_templates or []]
+        for path, source in sources:
+            item = load_template_item(path, source, None)
+            if item is None:
+                raise ValueError(f"template could not be loaded: {path}")
+            entry = {
+                "name": item.name,
+                "source": item.source,
+                "meta": item.meta,
+                "path": item.path,
+            }
+            add_template(entry, item.image, item.gray)
+
+    header["templates"] = templates
+    write_bundle(output_path, header, arrays)
+    return {
+        "rules": len(header.get("scene_rules", [])),
+        "templates": len(templates),
+        "arrays": len(arrays),
+        "bytes": os.path.getsize(output_path),
+    }
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(
+        description="Pack scene rules and templates into one memory-mappable bundle."
+    )
+    parser.add_argument("output", help="Bundle file to write (e.g. automation.sdb).")
+    parser.add_argument("--rules", help="Scene rules JSON (load_scene_rules format).")
+    parser.add_argument(
+        "--base-dir",
+        default=os.getcwd(),
+        help="Directory that rule template paths are relative to.",
+    )
+    parser.add_argument(
+        "--templates-json", help="Template list JSON (TemplateMatcher.load_from_json format)."
+    )
+    parser.add_argument(
+        "--program-templates",
+        nargs="*",
+        default=[],
+        help="Program-captured template image paths (png).",
+    )
+    parser.add_argument(
+        "--templates",
+        nargs="*",
+        default=[],
+        help="Local template image paths (png/jpg).",
+    )
+    args = parser.parse_args()
+
+    summary = build_bundle(
+        args.output,
+        rules_path=args.rules,
+        base_dir=args.base_dir,
+        templates_json=args.templates_json,
+        program_templates=args.program_templates,
+        local_templates=args.templates,
+    )
+    print(f"Bundle written: {args.output} {summary}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,117 @@
+import threading
+from typing import Any, Dict, List, Optional, Tuple
+
+import cv2
+import numpy as np
+
+
+ColorRange = Tuple[str, np.ndarray, np.ndarray]
+
+COLOR_SPACES = {
+    "bgr": None,
+    "gray": cv2.COLOR_BGR2GRAY,
+    "hsv": cv2.COLOR_BGR2HSV,
+    "lab": cv2.COLOR_BGR2LAB,
+}
+
+_RULES_PER_PLANE = 8
+_PLANE_BITS = ((np.arange(256)[:, None] >> np.arange(_RULES_PER_PLANE)) & 1).astype(np.int64)
+
+
+def parse_color_ranges(rule: Dict[str, Any], color_space: str = "bgr") -> List[ColorRange]:
+    items = rule.get("ranges")
+    if not items:
+        items = [
+            {
+                "lower": rule.get("lower", [0, 0, 0]),
+                "upper": rule.get("upper", [255, 255, 255]),
+            }
+        ]
+    ranges = []
+    for item in items:
+        space = str(item.get("space", color_space)).lower()
+        if space not in COLOR_SPACES:
+            raise ValueError(f"unknown color space '{space}'")
+        lower = np.array(item.get("lower", [0, 0, 0]), dtype=np.uint8)
+        upper = np.array(item.get("upper", [255, 255, 255]), dtype=np.uint8)
+        if lower.shape != upper.shape:
+            raise ValueError("lower and upper must have the same length")
+        ranges.append((space, lower, upper))
+    return ranges
+
+
+class ColorLut:
+    def __init__(self, rules: List[List[ColorRange]], bits: int = 6):
+        if not 1 <= bits <= 8:
+            raise ValueError("bits must be between 1 and 8")
+        self.bits = int(bits)
+        self.size = len(rules)
+        shift = 8 - self.bits
+        levels = np.arange(1 << self.bits, dtype=np.uint32)
+        values = np.arange(256, dtype=np.uint32) >> shift
+        self._b_table = (values << (2 * self.bits)).astype(np.uint32)
+        self._g_table = (values << self.bits).astype(np.uint32)
+        self._r_table = values.astype(np.uint32)
+        self._planes = self._build_planes(rules, (levels << shift) + ((1 << shift) >> 1))
+        self._buffers: Optional[Tuple[np.ndarray, np.ndarray, np.ndarray]] = None
+        self._lock = threading.Lock()
+
+    @property
+    def nbytes(self) -> int:
+        return sum(plane.nbytes for plane, _ in self._planes)
+
+    def _build_planes(
+        self, rules: List[List[ColorRange]], centers: np.ndarray
+    ) -> List[Tuple[np.ndarray, int]]:
+        # Every quantized BGR cell is classified once, at its center, in each space used.
+        b, g, r = np.meshgrid(centers, centers, centers, indexing="ij")
+        colors = np.stack([b, g, r], axis=-1).reshape(-1, 1, 3).astype(np.uint8)
+        converted: Dict[str, np.ndarray] = {}
+
+        def in_space(space: str) -> np.ndarray:
+            if space not in converted:
+                code = COLOR_SPACES[space]
+                image = colors if code is None else cv2.cvtColor(colors, code)
+                converted[space] = image.reshape(colors.shape[0], -1)
+            return converted[space]
+
+        planes = []
+        for start in range(0, len(rules), _RULES_PER_PLANE):
+            chunk = rules[start : start + _RULES_PER_PLANE]
+            plane = np.zeros(colors.shape[0], dtype=np.uint8)
+            for bit, ranges in enumerate(chunk):
+                inside = np.zeros(colors.shape[0], dtype=bool)
+                for space, lower, upper in ranges:
+                    values = in_space(space)
+                    inside |= np.all((values >= lower) & (values <= upper), axis=1)
+                plane[inside] |= np.uint8(1 << bit)
+            planes.append((plane, len(chunk)))
+        return planes
+
+    def _get_buffers(self, shape: Tuple[int, int]) -> Tuple[np.ndarray, np.ndarray, np.ndarray]:
+        buffers = self._buffers
+        if buffers is None or buffers[0].shape != shape:
+            buffers = (
+                np.empty(shape, dtype=np.uint32),
+                np.empty(shape, dtype=np.uint32),
+                np.empty(shape, dtype=np.uint8),
+            )
+            self._buffers = buffers
+        return buffers
+
+    def counts(self, roi: np.ndarray) -> np.ndarray:
+        if roi.ndim != 3 or roi.shape[2] != 3:
+            raise ValueError("color lut expects a BGR image")
+        with self._lock:
+            index, scratch, codes = self._get_buffers(roi.shape[:2])
+            np.take(self._b_table, roi[:, :, 0], out=index, mode="clip")
+            np.take(self._g_table, roi[:, :, 1], out=scratch, mode="clip")
+            np.add(index, scratch, out=index)
+            np.take(self._r_table, roi[:, :, 2], out=scratch, mode="clip")
+            np.add(index, scratch, out=index)
+            result = []
+            for plane, size in self._planes:
+                np.take(plane, index, out=codes, mode="clip")
+                histogram = np.bincount(codes.ravel(), minlength=256)
+                result.append(histogram @ _PLANE_BITS[:, :size])
+            return np.concatenate(result) if result else np.zeros(0, dtype=np.int64)
@@ -0,0 +1,119 @@
+import struct
+import threading
+import weakref
+from multiprocessing.shared_memory import SharedMemory
+from typing import Dict, List, Optional, Tuple
+
+import numpy as np
+
+
+# Shared-memory segment name, sequence number, shape, dtype.
+FrameRef = Tuple[str, int, Tuple[int, ...], str]
+
+# Slot layout: int64 sequence number, padding so the frame data stays aligned, frame bytes.
+SLOT_HEADER = 64
+_WRITING = -1
+_SEQ = struct.Struct("<q")
+
+
+def slot_sequence(segment: SharedMemory) -> int:
+    return _SEQ.unpack_from(segment.buf, 0)[0]
+
+
+class FrameRing:
+    # Frames are copied once into one of `slots` shared-memory segments, and worker processes
+    # attach by name and read them in place. Each slot header carries the frame's sequence
+    # number, so a reader can tell when the writer has lapped it.
+    def __init__(self, slots: int = 4):
+        self.slots = max(3, int(slots))
+        self.published = 0
+        self._segments: List[Optional[SharedMemory]] = [None] * self.slots
+        self._recent: List[Tuple["weakref.ref[np.ndarray]", FrameRef]] = []
+        self._lock = threading.Lock()
+
+    def publish(self, frame: np.ndarray) -> FrameRef:
+        with self._lock:
+            seq = self.published
+            self.published += 1
+            slot = seq % self.slots
+            segment = self._segments[slot]
+            if segment is None or segment.size < SLOT_HEADER + frame.nbytes:
+                if segment is not None:
+                    segment.close()
+                    segment.unlink()
+                segment = SharedMemory(create=True, size=SLOT_HEADER + frame.nbytes)
+                self._segments[slot] = segment
+            _SEQ.pack_into(segment.buf, 0, _WRITING)
+            view = np.ndarray(frame.shape, frame.dtype, buffer=segment.buf, offset=SLOT_HEADER)
+            view[...] = frame
+            del view
+            _SEQ.pack_into(segment.buf, 0, seq)
+            ref = (segment.name, seq, tuple(frame.shape), frame.dtype.str)
+            self._recent = [
+                (alive, old)
+                for alive, old in self._recent[-(self.slots - 1) :]
+                if alive() is not None
+            ]
+            self._recent.append((weakref.ref(frame), ref))
+        return ref
+
+    def ref_for(self, frame: np.ndarray) -> Optional[FrameRef]:
+        # The slot a frame was already published to, while at least two more publishes are
+        # needed before the writer reuses it.
+        with self._lock:
+            for alive, ref in reversed(self._recent):
+                if alive() is frame and ref[1] >= self.published - self.slots + 2:
+                    return ref
+        return None
+
+    def close(self) -> None:
+        with self._lock:
+            segments, self._segments = self._segments, [None] * self.slots
+            self._recent = []
+        for segment in segments:
+            if segment is not None:
+                segment.close()
+                segment.unlink()
+
+
+class FrameReader:
+    # Worker-side view of a FrameRing: keeps a few segments attached between frames.
+    def __init__(self, max_segments: int = 16):
+        self.max_segments = max(1, int(max_segments))
+        self._segments: Dict[str, SharedMemory] = {}
+
+    def _attach(self, name: str) -> SharedMemory:
+        segment = self._segments.get(name)
+        if segment is None:
+            while len(self._segments) >= self.max_segments:
+                self._close(self._segments.pop(next(iter(self._segments))))
+            segment = self._segments[name] = SharedMemory(name=name)
+        return segment
+
+    def read(self, ref: FrameRef) -> Optional[np.ndarray]:
+        # A zero-copy view of the frame, or None when the slot already holds a newer one.
+        name, seq, shape, dtype = ref
+        try:
+            segment = self._attach(name)
+        except FileNotFoundError:
+            return None
+        if slot_sequence(segment) != seq:
+            return None
+        return np.ndarray(shape, np.dtype(dtype), buffer=segment.buf, offset=SLOT_HEADER)
+
+    def still_valid(self, ref: FrameRef) -> bool:
+        segment = self._segments.get(ref[0])
+        return segment is not None and slot_sequence(segment) == ref[1]
+
+    @staticmethod
+    def _close(segment: SharedMemory) -> None:
+        try:
+            segment.close()
+        except BufferError:
+            # A view is still alive; the mapping goes away with it.
+            pass
+
+    def close(self) -> None:
+        for segment in self._segments.values():
+            self._close(segment)
+        self._segments = {}
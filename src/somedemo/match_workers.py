@@ -0,0 +1,428 @@
+import multiprocessing
+import threading
+import time
+from dataclasses import dataclass, replace
+from multiprocessing.connection import Connection
+from typing import Any, Callable, Dict, List, Optional, Tuple
+
+import numpy as np
+
+from somedemo.frame_ring import FrameReader, FrameRing
+from somedemo.scene_matcher import CompiledSceneRules, SceneMatch, compile_scene_rules
+from somedemo.template_matcher import MatchResult, TemplateMatcher
+
+
+def _build_templates(payload: Any, settings: Dict[str, Any]) -> TemplateMatcher:
+    matcher = TemplateMatcher(payload)
+    matcher.apply_settings(settings)
+    return matcher
+
+
+def _run_templates(
+    engine: TemplateMatcher, frame: np.ndarray
+) -> Optional[Tuple[int, MatchResult]]:
+    return engine.match_with_index(frame)
+
+
+def _build_scenes(payload: Any, settings: Dict[str, Any]) -> CompiledSceneRules:
+    compiled = compile_scene_rules(payload["rules"], base_dir=payload["base_dir"])
+    compiled.apply_settings(settings)
+    return compiled
+
+
+def _run_scenes(
+    engine: CompiledSceneRules, frame: np.ndarray, budget: Optional[float]
+) -> List[SceneMatch]:
+    deadline = None if budget is None else time.perf_counter() + budget
+    return engine.evaluate(frame, deadline=deadline)
+
+
+# Builder, runner (called with the frame and the extra arguments of MatchWorkerPool.run) and
+# the result reported for a partition whose match raised.
+_ENGINES: Dict[str, Tuple[Callable[..., Any], Callable[..., Any], Callable[[], Any]]] = {
+    "templates": (_build_templates, _run_templates, lambda: None),
+    "scenes": (_build_scenes, _run_scenes, list),
+}
+
+
+def _worker_main(conn: Connection, kind: str, payload: Any, settings: Dict[str, Any]) -> None:
+    build, run, _ = _ENGINES[kind]
+    engine = build(payload, settings)
+    reader = FrameReader()
+    conn.send(("ready", None, 0.0))
+    while True:
+        try:
+            job = conn.recv()
+        except (EOFError, OSError):
+            break
+        if job is None:
+            break
+        ref, args = job
+        start = time.perf_counter()
+        status, result = "stale", None
+        frame = reader.read(ref)
+        if frame is not None:
+            try:
+                result = run(engine, frame, *args)
+            except Exception as exc:
+                # Reported instead of raised, so the worker survives and the parent does not
+                # retry a match that would fail the same way in its own process.
+                status, result = "error", repr(exc)
+            else:
+                if reader.still_valid(ref):
+                    status = "ok"
+            del frame
+        conn.send((status, result, time.perf_counter() - start))
+    reader.close()
+
+
+def _partition(costs: List[float], parts: int) -> List[List[int]]:
+    # Greedy longest-first balancing; each partition keeps list order.
+    bins: List[List[int]] = [[] for _ in range(max(1, min(parts, len(costs))))]
+    loads = [0.0] * len(bins)
+    for index in sorted(range(len(costs)), key=lambda i: -costs[i]):
+        target = loads.index(min(loads))
+        bins[target].append(index)
+        loads[target] += costs[index]
+    return [sorted(indices) for indices in bins if indices]
+
+
+@dataclass(eq=False)
+class MatchWorker:
+    index: int
+    payload: Any
+    size: int
+    process: Optional[multiprocessing.process.BaseProcess] = None
+    conn: Optional[Connection] = None
+    alive: bool = False
+    started: float = 0.0
+    jobs: int = 0
+    busy: float = 0.0
+    stale: int = 0
+    errors: int = 0
+    pending: int = 0
+    missed: int = 0
+    timeouts: int = 0
+    late: int = 0
+    local_runs: int = 0
+    local_engine: Any = None
+    error: str = ""
+
+
+class MatchWorkerPool:
+    # Resident worker processes, each holding one partition of a template or rule set. Frames
+    # reach them through a FrameRing. A partition whose worker is late, died or hung, or whose
+    # frame slot was overwritten mid-read, is matched in this process instead; a worker is
+    # only given up after `max_missed` frames in a row without a timely reply. A partition
+    # whose match raised reports an empty result for that frame.
+    def __init__(
+        self,
+        kind: str,
+        payloads: List[Any],
+        sizes: List[int],
+        settings: Dict[str, Any],
+        ring: Optional[FrameRing] = None,
+        timeout: float = 10.0,
+        start_timeout: float = 60.0,
+        budget_grace: float = 0.5,
+        max_missed: int = 3,
+        log_callback: Optional[Callable[[str], None]] = None,
+    ):
+        self.kind = kind
+        self.settings = settings
+        self.ring = ring or FrameRing()
+        self.timeout = max(0.1, float(timeout))
+        self.start_timeout = max(0.1, float(start_timeout))
+        self.budget_grace = max(0.0, float(budget_grace))
+        self.max_missed = max(1, int(max_missed))
+        self.log_callback = log_callback
+        self.frames = 0
+        self.workers = [
+            MatchWorker(index, payload, size)
+            for index, (payload, size) in enumerate(zip(payloads, sizes))
+        ]
+        self._owns_ring = ring is None
+        self._context = multiprocessing.get_context("spawn")
+        self._lock = threading.Lock()
+
+    def _log(self, message: str) -> None:
+        if self.log_callback:
+            self.log_callback(message)
+
+    def start(self) -> int:
+        for worker in self.workers:
+            parent, child = self._context.Pipe()
+            worker.process = self._context.Process(
+                target=_worker_main,
+                args=(child, self.kind, worker.payload, self.settings),
+                name=f"somedemo-match-{worker.index}",
+                daemon=True,
+            )
+            worker.process.start()
+            child.close()
+            worker.conn = parent
+            worker.alive = True
+        deadline = time.perf_counter() + self.start_timeout
+        for worker in self.workers:
+            reply = self._receive(worker, max(0.1, deadline - time.perf_counter()))
+            worker.started = time.perf_counter()
+            if reply is None:
+                if worker.alive:
+                    self._retire(worker, "timeout")
+            elif reply[0] != "ready":
+                self._retire(worker, f"unexpected reply {reply[0]}")
+        return sum(worker.alive for worker in self.workers)
+
+    def _retire(self, worker: MatchWorker, reason: str) -> None:
+        worker.alive = False
+        worker.error = reason
+        if worker.process is not None and worker.process.is_alive():
+            worker.process.terminate()
+        if worker.conn is not None:
+            worker.conn.close()
+            worker.conn = None
+        self._log(f"匹配进程 {worker.index} 已退出，改为进程内匹配: {reason}")
+
+    def _receive(self, worker: MatchWorker, timeout: float) -> Optional[Tuple[str, Any, float]]:
+        # None when no reply arrived in time; a broken pipe also retires the worker.
+        try:
+            if worker.conn is not None and worker.conn.poll(timeout):
+                return worker.conn.recv()
+        except (EOFError, OSError) as exc:
+            self._retire(worker, str(exc) or type(exc).__name__)
+        return None
+
+    def _drain(self, worker: MatchWorker) -> bool:
+        # Discards replies to frames already matched here; False while the worker is still
+        # busy with one of them.
+        while worker.pending:
+            reply = self._receive(worker, 0.0)
+            if reply is None:
+                return False
+            worker.pending -= 1
+            worker.late += 1
+            worker.busy += reply[2]
+        return True
+
+    def _miss(self, worker: MatchWorker) -> None:
+        worker.timeouts += 1
+        worker.missed += 1
+        if worker.missed >= self.max_missed:
+            self._retire(worker, f"timeout ({worker.missed} frames in a row)")
+        elif worker.missed == 1:
+            self._log(f"匹配进程 {worker.index} 响应超时，本帧改为进程内匹配")
+
+    def _run_local(self, worker: MatchWorker, frame: np.ndarray, args: Tuple[Any, ...]) -> Any:
+        build, run, _ = _ENGINES[self.kind]
+        if worker.local_engine is None:
+            worker.local_engine = build(worker.payload, self.settings)
+        worker.local_runs += 1
+        return run(worker.local_engine, frame, *args)
+
+    def run(self, frame: np.ndarray, *args: Any, budget: Optional[float] = None) -> List[Any]:
+        # One result per partition, in partition order. `args` go to the engine's runner;
+        # `budget` (seconds) bounds the wait for workers at budget + budget_grace, after
+        # which a worker is treated as hung.
+        timeout = self.timeout if budget is None else min(self.timeout, budget + self.budget_grace)
+        with self._lock:
+            self.frames += 1
+            ref = self.ring.ref_for(frame) or self.ring.publish(frame)
+            sent: List[MatchWorker] = []
+            for worker in self.workers:
+                if not worker.alive or worker.conn is None:
+                    continue
+                if not self._drain(worker):
+                    if worker.alive:
+                        self._miss(worker)
+                    continue
+                try:
+                    worker.conn.send((ref, args))
+                    worker.pending += 1
+                    sent.append(worker)
+                except (OSError, ValueError) as exc:
+                    self._retire(worker, str(exc) or type(exc).__name__)
+            results: Dict[int, Any] = {}
+            # Partitions without a worker are matched here while the workers run.
+            for worker in self.workers:
+                if worker not in sent:
+                    results[worker.index] = self._run_local(worker, frame, args)
+            deadline = time.perf_counter() + timeout
+            for worker in sent:
+                reply = self._receive(worker, max(0.0, deadline - time.perf_counter()))
+                if reply is None:
+                    if worker.alive:
+                        self._miss(worker)
+                    results[worker.index] = self._run_local(worker, frame, args)
+                    continue
+                status, result, busy = reply
+                worker.pending -= 1
+                worker.missed = 0
+                worker.jobs += 1
+                worker.busy += busy
+                if status == "error":
+                    worker.errors += 1
+                    worker.error = result
+                    self._log(f"匹配进程 {worker.index} 匹配出错: {result}")
+                    result = _ENGINES[self.kind][2]()
+                elif status != "ok":
+                    worker.stale += 1
+                    result = self._run_local(worker, frame, args)
+                results[worker.index] = result
+            return [results[worker.index] for worker in self.workers]
+
+    def stats(self) -> Dict[str, Any]:
+        now = time.perf_counter()
+        workers = []
+        for worker in self.workers:
+            wall = now - worker.started if worker.started else 0.0
+            workers.append(
+                {
+                    "index": worker.index,
+                    "pid": worker.process.pid if worker.process else None,
+                    "alive": worker.alive,
+                    "items": worker.size,
+                    "jobs": worker.jobs,
+                    "busy_ms": worker.busy * 1000.0,
+                    "avg_ms": worker.busy / worker.jobs * 1000.0 if worker.jobs else 0.0,
+                    "utilization": worker.busy / wall if wall > 0 else 0.0,
+                    "stale": worker.stale,
+                    "timeouts": worker.timeouts,
+                    "late": worker.late,
+                    "errors": worker.errors,
+                    "local_runs": worker.local_runs,
+                    "error": worker.error,
+                }
+            )
+        return {
+            "frames": self.frames,
+            "ring": {"slots": self.ring.slots, "published": self.ring.published},
+            "workers": workers,
+        }
+
+    def close(self) -> None:
+        for worker in self.workers:
+            if worker.conn is not None:
+                try:
+                    worker.conn.send(None)
+                except (OSError, ValueError):
+                    pass
+        for worker in self.workers:
+            if worker.process is not None:
+                worker.process.join(timeout=2.0)
+                if worker.process.is_alive():
+                    worker.process.terminate()
+            if worker.conn is not None:
+                worker.conn.close()
+                worker.conn = None
+            worker.alive = False
+        if self._owns_ring:
+            self.ring.close()
+
+
+class ProcessTemplateMatcher:
+    # TemplateMatcher.match spread over worker processes, each holding a share of the
+    # templates balanced by template area. The merged result is the one the in-process
+    # matcher returns: highest confidence, earlier template on ties.
+    def __init__(
+        self,
+        matcher: TemplateMatcher,
+        workers: int = 4,
+        ring: Optional[FrameRing] = None,
+        timeout: float = 10.0,
+        log_callback: Optional[Callable[[str], None]] = None,
+    ):
+        templates = matcher.templates
+        costs = [float(tmpl["image"].shape[0] * tmpl["image"].shape[1]) for tmpl in templates]
+        self._parts = _partition(costs, workers)
+        self.pool = MatchWorkerPool(
+            "templates",
+            [[templates[i] for i in part] for part in self._parts],
+            [len(part) for part in self._parts],
+            matcher.export_settings(),
+            ring=ring,
+            timeout=timeout,
+            log_callback=log_callback,
+        )
+
+    def start(self) -> int:
+        return self.pool.start()
+
+    def match(self, frame: np.ndarray) -> Optional[MatchResult]:
+        best: Optional[Tuple[int, MatchResult]] = None
+        for part, found in zip(self._parts, self.pool.run(frame)):
+            if found is None:
+                continue
+            index, result = part[found[0]], found[1]
+            if (
+                best is None
+                or result["confidence"] > best[1]["confidence"]
+                or (result["confidence"] == best[1]["confidence"] and index < best[0])
+            ):
+                best = index, result
+        return best[1] if best else None
+
+    def stats(self) -> Dict[str, Any]:
+        return self.pool.stats()
+
+    def close(self) -> None:
+        self.pool.close()
+
+
+class ProcessSceneMatcher:
+    # CompiledSceneRules.evaluate / match spread over worker processes, each compiling its
+    # share of the top-level rules. Shares are balanced by measured rule cost once the
+    # scheduler has seen every rule, otherwise by count. Hits come back in declared order.
+    def __init__(
+        self,
+        compiled: CompiledSceneRules,
+        workers: int = 4,
+        ring: Optional[FrameRing] = None,
+        timeout: float = 10.0,
+        log_callback: Optional[Callable[[str], None]] = None,
+    ):
+        rules = compiled.rules
+        costs = [compiled.scheduler.cost(rule) for rule in rules]
+        if not all(cost > 0 for cost in costs):
+            costs = [1.0] * len(rules)
+        parts = _partition(costs, workers)
+        self._indices = {rule.name: rule.index for rule in rules}
+        self._order = {rule.name: position for position, rule in enumerate(rules)}
+        self.pool = MatchWorkerPool(
+            "scenes",
+            [
+                {"rules": [rules[i].rule for i in part], "base_dir": compiled.base_dir}
+                for part in parts
+            ],
+            [len(part) for part in parts],
+            compiled.export_settings(),
+            ring=ring,
+            timeout=timeout,
+            log_callback=log_callback,
+        )
+
+    def start(self) -> int:
+        return self.pool.start()
+
+    def evaluate(self, image: np.ndarray, deadline: Optional[float] = None) -> List[SceneMatch]:
+        budget = None if deadline is None else max(0.0, deadline - time.perf_counter())
+        hits = [
+            replace(hit, index=self._indices.get(hit.name, hit.index))
+            for part in self.pool.run(image, budget, budget=budget)
+            for hit in part
+        ]
+        hits.sort(key=lambda hit: self._order.get(hit.name, len(self._order)))
+        return hits
+
+    def match(
+        self, image: np.ndarray, max_workers: int = 1, deadline: Optional[float] = None
+    ) -> Optional[str]:
+        # Same signature as CompiledSceneRules.match; max_workers is unused here.
+        hits = self.evaluate(image, deadline=deadline)
+        found = next((hit for hit in hits if hit.held or not hit.deferred), None)
+        return found.name if found else None
+
+    def stats(self) -> Dict[str, Any]:
+        return self.pool.stats()
+
+    def close(self) -> None:
+        self.pool.close()
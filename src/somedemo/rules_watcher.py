@@ -0,0 +1,197 @@
+import threading
+import time
+from dataclasses import dataclass
+from typing import Callable, Dict, List, Optional, Tuple
+
+from somedemo.scene_matcher import (
+    CompiledSceneRules,
+    SceneRule,
+    file_signature,
+    load_scene_rules,
+    load_scene_transitions,
+    recompile_scene_rules,
+    resolve_rule_template,
+)
+from somedemo.template_matcher import TemplateMatcher
+
+
+Signature = Optional[Tuple[int, int]]
+
+
+@dataclass
+class RulesReload:
+    rules: Optional[List[SceneRule]] = None
+    compiled: Optional[CompiledSceneRules] = None
+    transitions: Optional[Dict[str, List[str]]] = None
+    template_matcher: Optional[TemplateMatcher] = None
+    recompiled: int = 0
+    elapsed: float = 0.0
+
+
+class RulesWatcher:
+    def __init__(
+        self,
+        rules_path: Optional[str] = None,
+        base_dir: Optional[str] = None,
+        compiled: Optional[CompiledSceneRules] = None,
+        template_paths: Optional[List[str]] = None,
+        template_threshold: float = 0.85,
+        interval: float = 1.0,
+        log_callback: Optional[Callable[[str], None]] = None,
+    ):
+        self.rules_path = rules_path
+        self.base_dir = base_dir
+        self.template_paths = list(template_paths or [])
+        self.template_threshold = float(template_threshold)
+        self.interval = max(0.1, float(interval))
+        self.log_callback = log_callback
+        self.reloads = 0
+        self.failures = 0
+
+        self._compiled = compiled
+        self._pending: Optional[RulesReload] = None
+        self._running = False
+        self._thread: Optional[threading.Thread] = None
+        self._stop_event = threading.Event()
+        self._lock = threading.Lock()
+        self._rule_files: Dict[str, Signature] = self._rule_snapshot(compiled)
+        self._template_files: Dict[str, Signature] = self._snapshot(self.template_paths)
+
+    def _log(self, message: str) -> None:
+        if self.log_callback:
+            self.log_callback(message)
+
+    @staticmethod
+    def _snapshot(paths: List[str]) -> Dict[str, Signature]:
+        return {path: file_signature(path) for path in paths}
+
+    def _rule_snapshot(self, compiled: Optional[CompiledSceneRules]) -> Dict[str, Signature]:
+        if not self.rules_path:
+            return {}
+        paths = [self.rules_path]
+        for rule in compiled.all_rules() if compiled else []:
+            if rule.type == "template" and "template_image" not in rule.rule:
+                path = resolve_rule_template(rule.rule, self.base_dir)
+                if path:
+                    paths.append(path)
+        return self._snapshot(paths)
+
+    @staticmethod
+    def _changed(files: Dict[str, Signature]) -> bool:
+        return any(file_signature(path) != signature for path, signature in files.items())
+
+    def start(self) -> bool:
+        if self._running:
+            return False
+        self._running = True
+        self._stop_event.clear()
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self._thread.start()
+        return True
+
+    def stop(self) -> bool:
+        if not self._running:
+            return False
+        self._stop_event.set()
+        if self._thread:
+            self._thread.join(timeout=2.0)
+        self._running = False
+        return True
+
+    def take_pending(self) -> Optional[RulesReload]:
+        # Called by the frame loop between frames, so a swap never lands mid-evaluation.
+        with self._lock:
+            pending, self._pending = self._pending, None
+        return pending
+
+    def poll(self) -> bool:
+        rules_changed = bool(self._rule_files) and self._changed(self._rule_files)
+        templates_changed = self._changed(self._template_files)
+        if not rules_changed and not templates_changed:
+            return False
+
+        start = time.perf_counter()
+        reload = RulesReload()
+        if rules_changed:
+            try:
+                self._reload_rules(reload)
+            except Exception as exc:
+                self.failures += 1
+                self._log(f"场景规则热加载失败，继续使用旧规则: {exc}")
+                reload.compiled = None
+        rules_reloaded = reload.compiled is not None
+        if templates_changed:
+            try:
+                self._reload_templates(reload)
+            except Exception as exc:
+                self.failures += 1
+                self._log(f"模板热加载失败，继续使用旧模板: {exc}")
+                reload.template_matcher = None
+        templates_reloaded = reload.template_matcher is not None
+        if reload.compiled is None and reload.template_matcher is None:
+            return False
+
+        reload.elapsed = time.perf_counter() - start
+        with self._lock:
+            previous = self._pending
+            if previous is not None:
+                # Frames have not picked up the last reload yet; keep its untouched half.
+                if reload.compiled is None:
+                    reload.rules = previous.rules
+                    reload.compiled = previous.compiled
+                    reload.transitions = previous.transitions
+                    reload.recompiled = previous.recompiled
+                if reload.template_matcher is None:
+                    reload.template_matcher = previous.template_matcher
+            self._pending = reload
+        self.reloads += 1
+        parts = []
+        if rules_reloaded:
+            parts.append(f"场景规则 {reload.recompiled}/{len(reload.compiled)} 条重新编译")
+        if templates_reloaded:
+            parts.append(f"模板 {len(reload.template_matcher.templates)} 个")
+        self._log(f"热加载完成 ({reload.elapsed * 1000.0:.1f} ms): {', '.join(parts)}")
+        return True
+
+    def _reload_rules(self, reload: RulesReload) -> None:
+        # Mark the current file versions as seen first, so a bad edit is reported once
+        # and retried only after the next change.
+        self._rule_files = self._snapshot(list(self._rule_files))
+        rules = load_scene_rules(self.rules_path)
+        compiled, recompiled = recompile_scene_rules(self._compiled, rules, self.base_dir)
+        self._rule_files = self._rule_snapshot(compiled)
+        missing = [
+            rule.name
+            for rule in compiled.all_rules()
+            if rule.type == "template" and rule.template is None
+        ]
+        if missing:
+            raise ValueError(f"模板无法读取: {', '.join(missing)}")
+        transitions = load_scene_transitions(self.rules_path)
+        self._compiled = compiled
+        reload.rules = rules
+        reload.compiled = compiled
+        reload.transitions = transitions
+        reload.recompiled = recompiled
+
+    def _reload_templates(self, reload: RulesReload) -> None:
+        # As with rules: a file caught mid-save fails to decode, and the whole set is kept
+        # until the next change rather than swapped for one missing that template.
+        self._template_files = self._snapshot(self.template_paths)
+        matcher = TemplateMatcher.load_from_paths(
+            self.template_paths, threshold=self.template_threshold
+        )
+        loaded = {tmpl["path"] for tmpl in matcher.templates}
+        missing = [path for path in self.template_paths if path not in loaded]
+        if missing:
+            raise ValueError(f"模板无法读取: {', '.join(missing)}")
+        reload.template_matcher = matcher
+
+    def _run(self) -> None:
+        while not self._stop_event.wait(self.interval):
+            try:
+                self.poll()
+            except Exception as exc:
+                self.failures += 1
+                self._log(f"热加载检查失败: {exc}")
+        self._running = False
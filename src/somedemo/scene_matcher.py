@@ -1,95 +1,1399 @@
 import json
+import math
 import os
-from typing import Any, Dict, List, Optional, Tuple
+import threading
+import time
+from concurrent.futures import Executor, Future, ThreadPoolExecutor
+from dataclasses import dataclass, field, replace
+from statistics import NormalDist
+from typing import (
+    Any,
+    Callable,
+    Dict,
+    Iterable,
+    Iterator,
+    List,
+    Optional,
+    Tuple,
+    TypeVar,
+    Union,
+)
 
 import cv2
 import numpy as np
 
+from somedemo.bundle import is_bundle, read_bundle
+from somedemo.color_lut import COLOR_SPACES, ColorLut, ColorRange, parse_color_ranges
+from somedemo.template_cache import load_image
+from somedemo.template_search import StatsPrefilter
+
 
 SceneRule = Dict[str, Any]
+RoiSlices = Tuple[slice, slice]
+RoiBounds = Tuple[int, int, int, int]
+T = TypeVar("T")
 
+COMPOSITE_TYPES = ("all", "any", "not")
 
-def load_scene_rules(path: str) -> List[SceneRule]:
+
+def _read_rules_file(path: str) -> Any:
     with open(path, "r", encoding="utf-8") as f:
-        data = json.load(f)
+        return json.load(f)
+
+
+def load_scene_rules(path: str) -> List[SceneRule]:
+    if is_bundle(path):
+        return read_bundle(path).scene_rules()
+    data = _read_rules_file(path)
+    if isinstance(data, dict):
+        data = data.get("rules")
     if not isinstance(data, list):
         raise ValueError("scene rules must be a list")
     return data
 
 
+def load_scene_transitions(path: str) -> Dict[str, List[str]]:
+    if is_bundle(path):
+        return read_bundle(path).transitions()
+    data = _read_rules_file(path)
+    if not isinstance(data, dict):
+        return {}
+    transitions = data.get("transitions") or {}
+    if not isinstance(transitions, dict):
+        raise ValueError("scene transitions must be a mapping")
+    return {str(name): [str(item) for item in targets] for name, targets in transitions.items()}
+
+
 def _resolve_path(base_dir: Optional[str], value: str) -> str:
     if os.path.isabs(value) or not base_dir:
         return value
     return os.path.join(base_dir, value)
 
 
-def _get_region(image: np.ndarray, region: Optional[List[int]]) -> Tuple[np.ndarray, int, int]:
+def resolve_rule_template(rule: SceneRule, base_dir: Optional[str]) -> Optional[str]:
+    template_path = rule.get("template")
+    if not template_path:
+        return None
+    return _resolve_path(base_dir, template_path)
+
+
+def _rule_key(rule: SceneRule) -> str:
+    # Bundle rules carry their decoded template; the bundle file itself is watched instead.
+    return json.dumps(
+        {k: v for k, v in rule.items() if k != "template_image"}, sort_keys=True, default=str
+    )
+
+
+def _clamp_region(region: Optional[List[int]]) -> Tuple[RoiSlices, int, int]:
     if not region:
-        return image, 0, 0
-    x, y, w, h = region
+        return (slice(None), slice(None)), 0, 0
+    x, y, w, h = (int(v) for v in region)
     x = max(0, x)
     y = max(0, y)
     w = max(0, w)
     h = max(0, h)
-    return image[y : y + h, x : x + w], x, y
+    return (slice(y, y + h), slice(x, x + w)), x, y
 
 
-def _match_template(
-    image: np.ndarray,
+def _get_region(image: np.ndarray, region: Optional[List[int]]) -> Tuple[np.ndarray, int, int]:
+    roi, x, y = _clamp_region(region)
+    return image[roi], x, y
+
+
+def _convert(image: np.ndarray, color_space: str, scale: float) -> np.ndarray:
+    code = COLOR_SPACES.get(color_space)
+    if code is not None and image.ndim == 3:
+        image = cv2.cvtColor(image, code)
+    if scale != 1.0 and image.size:
+        image = cv2.resize(image, None, fx=scale, fy=scale, interpolation=cv2.INTER_AREA)
+    return image
+
+
+@dataclass
+class CompiledRule:
+    name: str
+    type: str
+    index: int
+    rule: SceneRule
+    roi: RoiSlices
+    x: int = 0
+    y: int = 0
+    color_space: str = "bgr"
+    scale: float = 1.0
+    template: Optional[np.ndarray] = None
+    method: int = cv2.TM_CCOEFF_NORMED
+    threshold: float = 0.9
+    lower: Optional[np.ndarray] = None
+    upper: Optional[np.ndarray] = None
+    ratio: float = 1.0
+    ranges: List[ColorRange] = field(default_factory=list)
+    sample_budget: int = 0
+    sample_mode: str = "random"
+    sample_z: float = 2.576
+    every_n_frames: int = 1
+    min_interval: float = 0.0
+    priority: Optional[int] = None
+    source: Optional[Tuple[int, int]] = None
+    keywords: List[str] = field(default_factory=list)
+    lang: str = "chi_sim"
+    min_confidence: int = 60
+    children: List["CompiledRule"] = field(default_factory=list)
+
+
+def file_signature(path: Optional[str]) -> Optional[Tuple[int, int]]:
+    if not path:
+        return None
+    try:
+        stat = os.stat(path)
+    except OSError:
+        return None
+    return stat.st_mtime_ns, stat.st_size
+
+
+def _compile_child(
     rule: SceneRule,
+    parent: str,
+    position: int,
     base_dir: Optional[str],
-) -> bool:
-    template_path = rule.get("template")
-    if not template_path:
-        return False
-    template_path = _resolve_path(base_dir, template_path)
-    template = cv2.imread(template_path, cv2.IMREAD_UNCHANGED)
-    if template is None:
-        return False
-    if template.ndim == 3 and template.shape[2] == 4:
-        template = cv2.cvtColor(template, cv2.COLOR_BGRA2BGR)
+    leaves: Dict[str, CompiledRule],
+) -> CompiledRule:
+    # Identical children compile once, so composites that share a leaf share its result.
+    key = _rule_key(rule)
+    compiled = leaves.get(key)
+    if compiled is not None:
+        return compiled
+    named = dict(rule)
+    named.setdefault("name", f"{parent}.{position}")
+    compiled = _compile_rule(named, 0, base_dir, leaves)
+    if compiled is None:
+        raise ValueError(f"rule '{parent}' child {position} has no type")
+    # Children get negative indices so their per-rule state never collides with top-level
+    # rules; assigned after compiling so nested children have taken theirs already.
+    compiled.index = -(len(leaves) + 1)
+    leaves[key] = compiled
+    return compiled
+
+
+def _compile_rule(
+    rule: SceneRule,
+    index: int,
+    base_dir: Optional[str],
+    leaves: Optional[Dict[str, CompiledRule]] = None,
+) -> Optional[CompiledRule]:
+    name = rule.get("name")
+    rule_type = rule.get("type")
+    if not name or not rule_type:
+        return None
+    roi, x, y = _clamp_region(rule.get("region"))
+    compiled = CompiledRule(
+        name=name, type=rule_type, index=index, rule=rule, roi=roi, x=x, y=y
+    )
+    if rule.get("priority") is not None:
+        compiled.priority = int(rule["priority"])
+    compiled.every_n_frames = max(1, int(rule.get("every_n_frames", 1)))
+    compiled.min_interval = max(0.0, float(rule.get("min_interval_ms", 0.0)) / 1000.0)
+    color_space = str(rule.get("color_space", "bgr")).lower()
+    if color_space not in COLOR_SPACES:
+        raise ValueError(f"rule '{name}' has unknown color_space '{color_space}'")
+    compiled.color_space = color_space
+    compiled.scale = float(rule.get("scale", 1.0))
+    if compiled.scale <= 0:
+        raise ValueError(f"rule '{name}' scale must be positive")
+    if rule_type == "template":
+        template = rule.get("template_image")
+        template_path = resolve_rule_template(rule, base_dir)
+        if template is None and template_path:
+            compiled.source = file_signature(template_path)
+            template = load_image(template_path, cv2.IMREAD_UNCHANGED, "bgr")
+        if template is not None:
+            template = _convert(template, color_space, compiled.scale)
+        compiled.template = template
+        method_name = rule.get("method", "TM_CCOEFF_NORMED")
+        compiled.method = getattr(cv2, method_name, cv2.TM_CCOEFF_NORMED)
+        compiled.threshold = float(rule.get("threshold", 0.9))
+    elif rule_type == "color":
+        compiled.ranges = parse_color_ranges(rule, color_space)
+        _, compiled.lower, compiled.upper = compiled.ranges[0]
+        sample = rule.get("sample")
+        if sample:
+            _configure_sampling(compiled, **sample)
+        compiled.ratio = float(rule.get("ratio", 1.0))
+    elif rule_type == "text":
+        keywords = rule.get("keyword", [])
+        if isinstance(keywords, str):
+            keywords = [keywords]
+        compiled.keywords = [str(keyword) for keyword in keywords if keyword]
+        if not compiled.keywords:
+            raise ValueError(f"rule '{name}' needs at least one keyword")
+        compiled.lang = str(rule.get("lang", "chi_sim"))
+        compiled.min_confidence = int(rule.get("min_confidence", 60))
+    elif rule_type in COMPOSITE_TYPES:
+        children = rule.get("rules") or ([rule["rule"]] if rule.get("rule") else [])
+        if not children:
+            raise ValueError(f"rule '{name}' needs child rules")
+        if rule_type == "not" and len(children) != 1:
+            raise ValueError(f"rule '{name}' of type 'not' takes exactly one child rule")
+        leaves = {} if leaves is None else leaves
+        compiled.children = [
+            _compile_child(child, name, position, base_dir, leaves)
+            for position, child in enumerate(children)
+        ]
+    return compiled
+
+
+@dataclass
+class SceneMatch:
+    name: str
+    index: int
+    matched: bool
+    score: float
+    x: int
+    y: int
+    elapsed: float = 0.0
+    reused: bool = False
+    sampled: bool = False
+    deferred: bool = False
+    held: bool = False
+
+
+_executors: Dict[int, Executor] = {}
+_executors_lock = threading.Lock()
+
+
+def _get_executor(max_workers: int) -> Executor:
+    with _executors_lock:
+        executor = _executors.get(max_workers)
+        if executor is None:
+            executor = ThreadPoolExecutor(
+                max_workers=max_workers, thread_name_prefix="scene-matcher"
+            )
+            _executors[max_workers] = executor
+        return executor
+
+
+def stats_path_for(rules_path: str) -> str:
+    return os.path.splitext(rules_path)[0] + ".stats.json"
+
+
+class SceneRuleStats:
+    def __init__(self, cost_alpha: float = 0.05):
+        self.cost_alpha = float(cost_alpha)
+        self._rules: Dict[str, Dict[str, float]] = {}
+        self._lock = threading.Lock()
+
+    def record(self, result: SceneMatch) -> None:
+        with self._lock:
+            entry = self._rules.setdefault(
+                result.name, {"evaluations": 0, "hits": 0, "avg_cost": result.elapsed}
+            )
+            entry["evaluations"] += 1
+            if result.matched:
+                entry["hits"] += 1
+            entry["avg_cost"] += self.cost_alpha * (result.elapsed - entry["avg_cost"])
+
+    def hit_rate(self, name: str) -> float:
+        entry = self._rules.get(name)
+        if not entry:
+            return 0.5
+        return (entry["hits"] + 1.0) / (entry["evaluations"] + 2.0)
+
+    def avg_cost(self, name: str) -> float:
+        entry = self._rules.get(name)
+        return float(entry["avg_cost"]) if entry else 0.0
+
+    def rank(self, name: str) -> float:
+        # Cheap rules that usually fire first minimise the expected first-match cost.
+        return self.avg_cost(name) / self.hit_rate(name)
+
+    def to_dict(self) -> Dict[str, Dict[str, float]]:
+        with self._lock:
+            return {name: dict(entry) for name, entry in self._rules.items()}
+
+    def save(self, path: str) -> None:
+        with open(path, "w", encoding="utf-8") as f:
+            json.dump({"rules": self.to_dict()}, f, indent=2)
+
+    @classmethod
+    def load(cls, path: str) -> "SceneRuleStats":
+        stats = cls()
+        if not os.path.exists(path):
+            return stats
+        try:
+            with open(path, "r", encoding="utf-8") as f:
+                data = json.load(f)
+            for name, entry in data.get("rules", {}).items():
+                stats._rules[name] = {
+                    "evaluations": int(entry.get("evaluations", 0)),
+                    "hits": int(entry.get("hits", 0)),
+                    "avg_cost": float(entry.get("avg_cost", 0.0)),
+                }
+        except Exception:
+            return cls()
+        return stats
+
+
+def _roi_bounds(roi: RoiSlices, shape: Tuple[int, ...]) -> RoiBounds:
+    y0, y1, _ = roi[0].indices(shape[0])
+    x0, x1, _ = roi[1].indices(shape[1])
+    return y0, max(y0, y1), x0, max(x0, x1)
+
+
+class FrameContext:
+    def __init__(self, image: np.ndarray):
+        self.image = image
+        self.requests = 0
+        self.computed = 0
+        self._products: Dict[Tuple[Any, ...], Any] = {}
+        self._key_locks: Dict[Tuple[Any, ...], threading.Lock] = {}
+        self._lock = threading.Lock()
+
+    def shared(self, key: Tuple[Any, ...], build: Callable[[], T]) -> T:
+        with self._lock:
+            self.requests += 1
+            product = self._products.get(key)
+            if product is not None:
+                return product
+            key_lock = self._key_locks.setdefault(key, threading.Lock())
+        with key_lock:
+            product = self._products.get(key)
+            if product is None:
+                product = build()
+                with self._lock:
+                    self._products[key] = product
+                    self.computed += 1
+        return product
+
+    def _containing(self, bounds: RoiBounds, color_space: str) -> Optional[Tuple[RoiBounds, np.ndarray]]:
+        y0, y1, x0, x1 = bounds
+        with self._lock:
+            for key, product in self._products.items():
+                if key[0] != "roi" or key[2] != color_space or key[3] != 1.0:
+                    continue
+                py0, py1, px0, px1 = key[1]
+                if py0 <= y0 and y1 <= py1 and px0 <= x0 and x1 <= px1:
+                    return key[1], product
+        return None
+
+    def roi(self, rule: CompiledRule, color_space: Optional[str] = None) -> np.ndarray:
+        bounds = _roi_bounds(rule.roi, self.image.shape)
+        return self._product(bounds, color_space or rule.color_space, rule.scale)
+
+    def _product(self, bounds: RoiBounds, color_space: str, scale: float) -> np.ndarray:
+        def build() -> np.ndarray:
+            y0, y1, x0, x1 = bounds
+            if scale != 1.0:
+                return _convert(self._product(bounds, color_space, 1.0), "bgr", scale)
+            if color_space == "bgr":
+                return self.image[y0:y1, x0:x1]
+            # Nested regions reuse the conversion of an enclosing ROI from the same frame.
+            parent = self._containing(bounds, color_space)
+            if parent is not None:
+                (py0, _, px0, _), product = parent
+                return product[y0 - py0 : y1 - py0, x0 - px0 : x1 - px0]
+            return _convert(self.image[y0:y1, x0:x1], color_space, 1.0)
+
+        return self.shared(("roi", bounds, color_space, scale), build)
+
+    def fingerprint(self, rule: CompiledRule, grid: int) -> Optional[np.ndarray]:
+        bounds = _roi_bounds(rule.roi, self.image.shape)
+        y0, y1, x0, x1 = bounds
+        if y1 <= y0 or x1 <= x0:
+            return None
+
+        def build() -> np.ndarray:
+            roi = self._product(bounds, "bgr", 1.0)
+            size = (min(grid, roi.shape[1]), min(grid, roi.shape[0]))
+            return cv2.resize(roi, size, interpolation=cv2.INTER_AREA)
+
+        return self.shared(("fingerprint", bounds, grid), build)
+
+
+class ColorRuleBatch:
+    def __init__(self) -> None:
+        self.luts: Dict[int, Tuple[ColorLut, int]] = {}
+        self._masks: Dict[Tuple[int, int], np.ndarray] = {}
+        self._samplers: Dict[Tuple[int, int, int], Callable[[np.ndarray], np.ndarray]] = {}
+        self._lock = threading.Lock()
+
+    def _mask(self, rule: CompiledRule, slot: int, shape: Tuple[int, ...]) -> np.ndarray:
+        mask = self._masks.get((rule.index, slot))
+        if mask is None or mask.shape != shape:
+            mask = np.empty(shape, dtype=np.uint8)
+            self._masks[(rule.index, slot)] = mask
+        return mask
+
+    def _sampler(
+        self, rule: CompiledRule, shape: Tuple[int, ...]
+    ) -> Optional[Callable[[np.ndarray], np.ndarray]]:
+        height, width = shape[:2]
+        if rule.sample_budget <= 0 or height * width <= 2 * rule.sample_budget:
+            return None
+        key = (rule.index, height, width)
+        sampler = self._samplers.get(key)
+        if sampler is None:
+            if rule.sample_mode == "random":
+                # Composite children have negative indices; the seed must not.
+                rng = np.random.default_rng(abs(rule.index))
+                flat = np.sort(rng.choice(height * width, size=rule.sample_budget, replace=False))
+                rows, cols = np.divmod(flat, width)
+
+                def sampler(roi: np.ndarray) -> np.ndarray:
+                    return roi[rows, cols][:, None]
+
+            else:
+                step = int(math.ceil(math.sqrt(height * width / float(rule.sample_budget))))
+                offset = step // 2
+
+                def sampler(roi: np.ndarray) -> np.ndarray:
+                    return roi[offset::step, offset::step]
+
+            self._samplers[key] = sampler
+        return sampler
+
+    def _count(
+        self,
+        context: FrameContext,
+        rule: CompiledRule,
+        view: Callable[[np.ndarray], np.ndarray],
+        slot: int,
+    ) -> Tuple[int, int]:
+        roi = view(context.roi(rule))
+        mask = self._mask(rule, slot, roi.shape[:2])
+        for pos, (space, lower, upper) in enumerate(rule.ranges):
+            src = roi if space == rule.color_space else view(context.roi(rule, space))
+            if pos == 0:
+                cv2.inRange(src, lower, upper, dst=mask)
+            else:
+                extra = self._mask(rule, slot + 1, roi.shape[:2])
+                cv2.inRange(src, lower, upper, dst=extra)
+                cv2.bitwise_or(mask, extra, dst=mask)
+        return cv2.countNonZero(mask), mask.size
+
+    def ratio(self, context: FrameContext, rule: CompiledRule) -> Tuple[float, bool]:
+        entry = self.luts.get(rule.index)
+        if entry is not None:
+            return self._lut_ratio(context, rule, *entry), False
+        roi = context.roi(rule)
+        if roi.size == 0:
+            return float("-inf"), False
+        with self._lock:
+            sampler = self._sampler(rule, roi.shape)
+            if sampler is not None:
+                hits, total = self._count(context, rule, sampler, 2)
+                low, high = _wilson_interval(hits, total, rule.sample_z)
+                # Trust the sample whenever its interval lies entirely on one side of the threshold.
+                if low >= rule.ratio or high < rule.ratio:
+                    return hits / float(total), True
+            hits, total = self._count(context, rule, lambda view: view, 0)
+            return hits / float(total), False
+
+    def _lut_ratio(
+        self, context: FrameContext, rule: CompiledRule, lut: ColorLut, pos: int
+    ) -> float:
+        roi = context.roi(rule, "bgr")
+        if roi.size == 0:
+            return float("-inf")
+        counts = context.shared(("lut", id(lut)), lambda: lut.counts(roi))
+        return float(counts[pos]) / float(roi.shape[0] * roi.shape[1])
+
+    def build_luts(self, rules: List[CompiledRule], bits: int) -> None:
+        groups: Dict[Tuple[Any, ...], List[CompiledRule]] = {}
+        for rule in rules:
+            if rule.type != "color":
+                continue
+            key = (
+                rule.roi[0].start,
+                rule.roi[0].stop,
+                rule.roi[1].start,
+                rule.roi[1].stop,
+                rule.scale,
+            )
+            groups.setdefault(key, []).append(rule)
+        luts: Dict[int, Tuple[ColorLut, int]] = {}
+        for members in groups.values():
+            lut = ColorLut([rule.ranges for rule in members], bits=bits)
+            for pos, rule in enumerate(members):
+                luts[rule.index] = (lut, pos)
+        self.luts = luts
+
+
+class TextRuleReader:
+    def __init__(
+        self,
+        max_workers: int = 1,
+        max_backoff: int = 64,
+        log_callback: Optional[Callable[[str], None]] = None,
+    ):
+        self.max_workers = max(1, int(max_workers))
+        self.max_backoff = max(1, int(max_backoff))
+        self.log_callback = log_callback
+        self.submitted = 0
+        self.completed = 0
+        self.errors = 0
+        self._executor: Optional[Executor] = None
+        self._pending: Dict[int, Future] = {}
+        self._latest: Dict[int, Tuple[float, int, int, bool]] = {}
+        self._failures: Dict[int, int] = {}
+        self._backoff: Dict[int, int] = {}
+        self._lock = threading.Lock()
+
+    def _log(self, message: str) -> None:
+        if self.log_callback:
+            self.log_callback(message)
+
+    def _failed(self, rule: CompiledRule, exc: Exception) -> None:
+        # The first failure in a row is logged; from the second on, the region is only
+        # resubmitted after 2, 4, 8 ... reads (capped at max_backoff).
+        failures = self._failures.get(rule.index, 0) + 1
+        self._failures[rule.index] = failures
+        if failures == 1:
+            self._log(f"文字规则 {rule.name} 识别失败: {exc!r}")
+        else:
+            self._backoff[rule.index] = min(2 ** (failures - 1), self.max_backoff)
+
+    def read(self, context: FrameContext, rule: CompiledRule) -> Tuple[float, int, int, bool]:
+        # OCR runs off the frame path; the verdict is the latest finished read of the region.
+        with self._lock:
+            future = self._pending.get(rule.index)
+            if future is not None and future.done():
+                del self._pending[rule.index]
+                try:
+                    self._latest[rule.index] = future.result()
+                    self.completed += 1
+                    self._failures.pop(rule.index, None)
+                except Exception as exc:
+                    self.errors += 1
+                    self._failed(rule, exc)
+                future = None
+            backoff = self._backoff.get(rule.index, 0)
+            if backoff:
+                self._backoff[rule.index] = backoff - 1
+            elif future is None:
+                roi = context.roi(rule)
+                if roi.size:
+                    if roi.ndim == 3:
+                        roi = cv2.cvtColor(roi, cv2.COLOR_BGR2RGB)
+                    else:
+                        roi = roi.copy()
+                    if self._executor is None:
+                        self._executor = ThreadPoolExecutor(
+                            max_workers=self.max_workers, thread_name_prefix="scene-ocr"
+                        )
+                    self._pending[rule.index] = self._executor.submit(_read_text, rule, roi)
+                    self.submitted += 1
+            return self._latest.get(rule.index, (float("-inf"), rule.x, rule.y, False))
+
+    def stats(self) -> Dict[str, int]:
+        with self._lock:
+            return {
+                "submitted": self.submitted,
+                "completed": self.completed,
+                "errors": self.errors,
+                "in_flight": len(self._pending),
+                "backing_off": sum(1 for left in self._backoff.values() if left),
+            }
+
+
+def _read_text(rule: CompiledRule, roi: np.ndarray) -> Tuple[float, int, int, bool]:
+    # Imported here so pytesseract is only needed when a rule set uses text rules.
+    from somedemo.text_ocr import iter_image_text_boxes
+
+    best = float("-inf")
+    for text, conf, x, y, w, h in iter_image_text_boxes(roi, rule.lang):
+        best = max(best, conf / 100.0)
+        if conf < rule.min_confidence or not any(kw in text for kw in rule.keywords):
+            continue
+        cx = rule.x + int(round((x + max(w // 2, 1)) / rule.scale))
+        cy = rule.y + int(round((y + max(h // 2, 1)) / rule.scale))
+        return conf / 100.0, cx, cy, True
+    return best, rule.x, rule.y, False
+
 
-    region = rule.get("region")
-    roi, _, _ = _get_region(image, region)
+class RoiReuseCache:
+    # Approximate: the fingerprint is a grid x grid area average of the ROI, so a change that
+    # moves no cell average by more than `tolerance` (a few pixels, a thin caret) goes unseen
+    # and the previous verdict can be returned for up to `max_age` seconds.
+    def __init__(self, tolerance: float = 0.0, max_age: float = 0.5, grid: int = 32):
+        self.tolerance = float(tolerance)
+        self.max_age = float(max_age)
+        self.grid = max(1, int(grid))
+        self.skipped: Dict[str, int] = {}
+        self.evaluated: Dict[str, int] = {}
+        self._entries: Dict[int, Tuple[np.ndarray, SceneMatch, float]] = {}
+        self._lock = threading.Lock()
+
+    def lookup(
+        self, rule: CompiledRule, fingerprint: Optional[np.ndarray], now: float
+    ) -> Optional[SceneMatch]:
+        entry = self._entries.get(rule.index)
+        if entry is None or fingerprint is None:
+            return None
+        previous, result, ts = entry
+        if now - ts > self.max_age or previous.shape != fingerprint.shape:
+            return None
+        if cv2.norm(previous, fingerprint, cv2.NORM_INF) > self.tolerance:
+            return None
+        with self._lock:
+            self.skipped[rule.name] = self.skipped.get(rule.name, 0) + 1
+        return result
+
+    def store(
+        self, rule: CompiledRule, fingerprint: Optional[np.ndarray], result: SceneMatch, now: float
+    ) -> None:
+        with self._lock:
+            self.evaluated[rule.name] = self.evaluated.get(rule.name, 0) + 1
+        if fingerprint is None:
+            self._entries.pop(rule.index, None)
+            return
+        self._entries[rule.index] = (fingerprint, result, now)
+
+    def stats(self) -> Dict[str, Any]:
+        with self._lock:
+            skipped = sum(self.skipped.values())
+            evaluated = sum(self.evaluated.values())
+            return {
+                "skipped": skipped,
+                "evaluated": evaluated,
+                "skip_ratio": skipped / float(skipped + evaluated) if skipped + evaluated else 0.0,
+                "rules": {
+                    name: {
+                        "skipped": self.skipped.get(name, 0),
+                        "evaluated": self.evaluated.get(name, 0),
+                    }
+                    for name in set(self.skipped) | set(self.evaluated)
+                },
+            }
+
+
+class RuleScheduler:
+    def __init__(self, max_staleness: int = 5, cost_alpha: float = 0.2):
+        self.max_staleness = max(1, int(max_staleness))
+        self.cost_alpha = float(cost_alpha)
+        self.frame = 0
+        self._last: Dict[int, SceneMatch] = {}
+        self._last_frame: Dict[int, int] = {}
+        self._last_ts: Dict[int, float] = {}
+        self._cost: Dict[int, float] = {}
+        self._deferrals: Dict[str, int] = {}
+        self._tier_skips: Dict[str, int] = {}
+        self._worst_staleness: Dict[str, int] = {}
+        self._lock = threading.Lock()
+
+    def next_frame(self) -> int:
+        with self._lock:
+            self.frame += 1
+            return self.frame
+
+    def staleness(self, rule: CompiledRule) -> float:
+        last = self._last_frame.get(rule.index)
+        return float("inf") if last is None else float(self.frame - last)
+
+    def cost(self, rule: CompiledRule) -> float:
+        return self._cost.get(rule.index, 0.0)
+
+    def is_due(self, rule: CompiledRule, now: float) -> bool:
+        last = self._last_frame.get(rule.index)
+        if last is None:
+            return True
+        if self.frame - last < rule.every_n_frames:
+            return False
+        return now - self._last_ts.get(rule.index, 0.0) >= rule.min_interval
+
+    def is_overdue(self, rule: CompiledRule) -> bool:
+        return self.staleness(rule) >= rule.every_n_frames - 1 + self.max_staleness
+
+    def plan(self, rules: List[CompiledRule]) -> List[CompiledRule]:
+        # Rules deferred on earlier frames are stalest, so they lead the rotation;
+        # rules that ran last frame follow in ascending cost order.
+        return sorted(
+            rules,
+            key=lambda rule: (-min(self.staleness(rule), self.max_staleness), self.cost(rule)),
+        )
+
+    def record(self, rule: CompiledRule, result: SceneMatch) -> None:
+        with self._lock:
+            staleness = self.staleness(rule)
+            if staleness != float("inf"):
+                worst = self._worst_staleness.get(rule.name, 0)
+                self._worst_staleness[rule.name] = max(worst, int(staleness))
+            self._last[rule.index] = result
+            self._last_frame[rule.index] = self.frame
+            self._last_ts[rule.index] = time.monotonic()
+        if not result.reused:
+            self.record_cost(rule, result.elapsed)
+
+    def record_cost(self, rule: CompiledRule, elapsed: float) -> None:
+        with self._lock:
+            cost = self._cost.get(rule.index, elapsed)
+            self._cost[rule.index] = cost + self.cost_alpha * (elapsed - cost)
+
+    def _last_verdict(
+        self, rule: CompiledRule, counter: Dict[str, int], held: bool
+    ) -> Optional[SceneMatch]:
+        with self._lock:
+            counter[rule.name] = counter.get(rule.name, 0) + 1
+            last = self._last.get(rule.index)
+        if last is None:
+            return None
+        return replace(last, elapsed=0.0, deferred=True, held=held)
+
+    def defer(self, rule: CompiledRule) -> Optional[SceneMatch]:
+        return self._last_verdict(rule, self._deferrals, held=False)
+
+    def hold(self, rule: CompiledRule) -> Optional[SceneMatch]:
+        return self._last_verdict(rule, self._tier_skips, held=True)
+
+    def stats(self) -> Dict[str, Dict[str, float]]:
+        with self._lock:
+            names = {rule_index: result.name for rule_index, result in self._last.items()}
+            return {
+                name: {
+                    "deferrals": self._deferrals.get(name, 0),
+                    "tier_skips": self._tier_skips.get(name, 0),
+                    "staleness": self.frame - self._last_frame[rule_index],
+                    "max_staleness": self._worst_staleness.get(name, 0),
+                    "avg_cost": self._cost.get(rule_index, 0.0),
+                }
+                for rule_index, name in names.items()
+            }
+
+
+def _configure_sampling(
+    rule: CompiledRule,
+    budget: int = 4096,
+    mode: str = "random",
+    confidence: float = 0.99,
+) -> None:
+    if mode not in ("strided", "random"):
+        raise ValueError(f"rule '{rule.name}' sample mode must be 'strided' or 'random'")
+    if not 0.0 < confidence < 1.0:
+        raise ValueError(f"rule '{rule.name}' sample confidence must be in (0, 1)")
+    rule.sample_budget = max(0, int(budget))
+    rule.sample_mode = mode
+    rule.sample_z = NormalDist().inv_cdf(0.5 + confidence / 2.0)
+
+
+def _wilson_interval(hits: int, total: int, z: float) -> Tuple[float, float]:
+    p = hits / float(total)
+    z2 = z * z
+    denom = 1.0 + z2 / total
+    center = (p + z2 / (2.0 * total)) / denom
+    half = z / denom * math.sqrt(p * (1.0 - p) / total + z2 / (4.0 * total * total))
+    return center - half, center + half
+
+
+class CompiledSceneRules:
+    def __init__(
+        self,
+        rules: List[CompiledRule],
+        base_dir: Optional[str] = None,
+        log_callback: Optional[Callable[[str], None]] = None,
+    ):
+        self.rules = rules
+        self.base_dir = base_dir
+        self.log_callback = log_callback
+        self.adaptive = False
+        self.stats: Optional[SceneRuleStats] = None
+        self.stats_path: Optional[str] = None
+        self.reorder_interval = 30
+        self._order: Optional[List[CompiledRule]] = None
+        self._evaluations_since_reorder = 0
+        self.reuse: Optional[RoiReuseCache] = None
+        self.scheduler = RuleScheduler()
+        self._colors = ColorRuleBatch()
+        self._texts = TextRuleReader(log_callback=self._log)
+        self.prefilter: Optional[StatsPrefilter] = None
+        self._sampling: Optional[Tuple[int, str, float]] = None
+        self._lut_bits: Optional[int] = None
+        self._debug = {
+            "frames": 0,
+            "requests": 0,
+            "computed": 0,
+            "last_requests": 0,
+            "last_computed": 0,
+        }
+        self._debug_lock = threading.Lock()
+
+    def _log(self, message: str) -> None:
+        if self.log_callback:
+            self.log_callback(message)
+
+    def __len__(self) -> int:
+        return len(self.rules)
+
+    def __iter__(self) -> Iterator[CompiledRule]:
+        return iter(self.rules)
+
+    def get(self, name: str) -> Optional[CompiledRule]:
+        return next((rule for rule in self.rules if rule.name == name), None)
+
+    def all_rules(self) -> List[CompiledRule]:
+        # Top-level rules followed by every nested child of a composite, each once.
+        result: Dict[int, CompiledRule] = {}
+        pending = list(self.rules)
+        while pending:
+            rule = pending.pop(0)
+            if rule.index not in result:
+                result[rule.index] = rule
+                pending.extend(rule.children)
+        return list(result.values())
+
+    def subset(self, names: Iterable[str]) -> "CompiledSceneRules":
+        wanted = set(names)
+        subset = CompiledSceneRules(
+            [rule for rule in self.rules if rule.name in wanted],
+            base_dir=self.base_dir,
+            log_callback=self.log_callback,
+        )
+        subset.adaptive = self.adaptive
+        subset.stats = self.stats
+        subset.stats_path = self.stats_path
+        subset.reorder_interval = self.reorder_interval
+        subset.reuse = self.reuse
+        subset.scheduler = self.scheduler
+        subset._colors = self._colors
+        subset._texts = self._texts
+        subset.prefilter = self.prefilter
+        return subset
+
+    def enable_adaptive_order(
+        self, stats_path: Optional[str] = None, reorder_interval: int = 30
+    ) -> None:
+        self.stats_path = stats_path
+        self.stats = SceneRuleStats.load(stats_path) if stats_path else SceneRuleStats()
+        self.reorder_interval = max(1, int(reorder_interval))
+        self.adaptive = True
+        self._order = None
+
+    def enable_roi_reuse(
+        self, tolerance: float = 0.0, max_age: float = 0.5, grid: int = 32
+    ) -> RoiReuseCache:
+        self.reuse = RoiReuseCache(tolerance=tolerance, max_age=max_age, grid=grid)
+        return self.reuse
+
+    def set_max_staleness(self, max_staleness: int) -> None:
+        self.scheduler.max_staleness = max(1, int(max_staleness))
+
+    def enable_sampling(
+        self,
+        budget: int = 4096,
+        mode: str = "random",
+        confidence: float = 0.99,
+    ) -> None:
+        self._sampling = (budget, mode, confidence)
+        for rule in self.all_rules():
+            if rule.type == "color" and not rule.rule.get("sample"):
+                _configure_sampling(rule, budget, mode, confidence)
+
+    def enable_color_lut(self, bits: int = 6) -> None:
+        self._lut_bits = bits
+        self._colors.build_luts(self.all_rules(), bits)
+
+    def enable_prefilter(self) -> StatsPrefilter:
+        self.prefilter = StatsPrefilter()
+        return self.prefilter
+
+    def export_settings(self) -> Dict[str, Any]:
+        # Plain-data form of the per-rule-set configuration, for compiling the same rules
+        # elsewhere (see match_workers). Adaptive ordering and its stats file stay here.
+        settings: Dict[str, Any] = {"max_staleness": self.scheduler.max_staleness}
+        if self.reuse is not None:
+            settings["roi_reuse"] = (self.reuse.tolerance, self.reuse.max_age, self.reuse.grid)
+        if self.prefilter is not None:
+            settings["prefilter"] = True
+        if self._sampling is not None:
+            settings["sampling"] = self._sampling
+        if self._lut_bits is not None:
+            settings["color_lut"] = self._lut_bits
+        return settings
+
+    def apply_settings(self, settings: Dict[str, Any]) -> None:
+        self.set_max_staleness(settings.get("max_staleness", self.scheduler.max_staleness))
+        if "roi_reuse" in settings:
+            self.enable_roi_reuse(*settings["roi_reuse"])
+        if "prefilter" in settings:
+            self.enable_prefilter()
+        if "sampling" in settings:
+            self.enable_sampling(*settings["sampling"])
+        if "color_lut" in settings:
+            self.enable_color_lut(settings["color_lut"])
+
+    def inherit_settings(self, previous: "CompiledSceneRules") -> None:
+        # Learned statistics survive a reload; per-frame caches start fresh because
+        # rule indices may have moved.
+        self.log_callback = previous.log_callback
+        self.adaptive = previous.adaptive
+        self.stats = previous.stats
+        self.stats_path = previous.stats_path
+        self.reorder_interval = previous.reorder_interval
+        self.scheduler.max_staleness = previous.scheduler.max_staleness
+        self.prefilter = previous.prefilter
+        if previous.reuse is not None:
+            reuse = previous.reuse
+            self.enable_roi_reuse(reuse.tolerance, reuse.max_age, reuse.grid)
+        if previous._sampling is not None:
+            self.enable_sampling(*previous._sampling)
+        if previous._lut_bits is not None:
+            self.enable_color_lut(previous._lut_bits)
+
+    def save_stats(self) -> bool:
+        if not self.stats or not self.stats_path:
+            return False
+        self.stats.save(self.stats_path)
+        return True
+
+    def evaluation_order(self) -> List[CompiledRule]:
+        if not self.adaptive or not self.stats:
+            return self.rules
+        if self._order is None or self._evaluations_since_reorder >= self.reorder_interval:
+            stats = self.stats
+
+            # Rules with an explicit priority group keep their file order inside the group;
+            # unmarked rules join group 0 after them and are sorted by expected cost.
+            def key(rule: CompiledRule) -> Tuple[int, int, float]:
+                if rule.priority is not None:
+                    return rule.priority, 0, float(rule.index)
+                return 0, 1, stats.rank(rule.name)
+
+            self._order = sorted(self.rules, key=key)
+            self._evaluations_since_reorder = 0
+        self._evaluations_since_reorder += 1
+        return self._order
+
+    def _compute(self, context: FrameContext, rule: CompiledRule) -> SceneMatch:
+        if rule.children:
+            return self._evaluate_composite(context, rule)
+        reuse = self.reuse
+        # Text verdicts already come from an earlier frame, so they are never reused.
+        if reuse is None or rule.type == "text":
+            return _evaluate_rule(context, rule, self._colors, self._texts, self.prefilter)
+        start = time.perf_counter()
+        fingerprint = context.fingerprint(rule, reuse.grid)
+        previous = reuse.lookup(rule, fingerprint, start)
+        if previous is not None:
+            return replace(previous, elapsed=time.perf_counter() - start, reused=True)
+        result = _evaluate_rule(context, rule, self._colors, self._texts, self.prefilter)
+        reuse.store(rule, fingerprint, result, start)
+        return result
+
+    def _evaluate_child(self, context: FrameContext, rule: CompiledRule) -> SceneMatch:
+        def build() -> SceneMatch:
+            result = self._compute(context, rule)
+            if not result.reused:
+                self.scheduler.record_cost(rule, result.elapsed)
+            return result
+
+        return context.shared(("rule", rule.index), build)
+
+    def _evaluate_composite(self, context: FrameContext, rule: CompiledRule) -> SceneMatch:
+        start = time.perf_counter()
+        # Cheapest child first; stop as soon as one result decides the outcome.
+        decisive = rule.type == "any"
+        results: Dict[int, SceneMatch] = {}
+        for child in sorted(rule.children, key=self.scheduler.cost):
+            result = self._evaluate_child(context, child)
+            results[child.index] = result
+            if result.matched == decisive:
+                break
+        if rule.type == "not":
+            matched = not results[rule.children[0].index].matched
+        elif rule.type == "any":
+            matched = any(result.matched for result in results.values())
+        else:
+            matched = all(result.matched for result in results.values())
+        x, y = rule.x, rule.y
+        if matched and rule.type != "not":
+            located = next(
+                (
+                    results[child.index]
+                    for child in rule.children
+                    if child.type != "not"
+                    and child.index in results
+                    and results[child.index].matched
+                ),
+                None,
+            )
+            if located is not None:
+                x, y = located.x, located.y
+        elapsed = time.perf_counter() - start
+        return SceneMatch(
+            rule.name, rule.index, matched, 1.0 if matched else 0.0, x, y, elapsed
+        )
+
+    def _evaluate(self, context: FrameContext, rule: CompiledRule) -> SceneMatch:
+        result = self._compute(context, rule)
+        self.scheduler.record(rule, result)
+        if self.adaptive and self.stats and not result.reused:
+            self.stats.record(result)
+        return result
+
+    def _evaluate_many(
+        self, context: FrameContext, rules: List[CompiledRule]
+    ) -> Dict[int, SceneMatch]:
+        return {rule.index: self._evaluate(context, rule) for rule in rules}
+
+    def evaluate(
+        self,
+        image: np.ndarray,
+        max_workers: int = 1,
+        first_only: bool = False,
+        deadline: Optional[float] = None,
+    ) -> List[SceneMatch]:
+        context = FrameContext(image)
+        scheduler = self.scheduler
+        scheduler.next_frame()
+        now = time.monotonic()
+        order = self.evaluation_order() if first_only else self.rules
+        # Rules outside their frequency tier keep their last verdict this frame.
+        held = {
+            rule.index: scheduler.hold(rule)
+            for rule in order
+            if not scheduler.is_due(rule, now)
+        }
+        try:
+            if deadline is not None:
+                return self._evaluate_budgeted(context, order, held, first_only, deadline)
+            return self._evaluate_frame(context, order, held, max_workers, first_only)
+        finally:
+            self._record_context(context)
+
+    def _evaluate_budgeted(
+        self,
+        context: FrameContext,
+        order: List[CompiledRule],
+        held: Dict[int, Optional[SceneMatch]],
+        first_only: bool,
+        deadline: float,
+    ) -> List[SceneMatch]:
+        if first_only:
+            return self._first_budgeted(context, order, held, deadline)
+        scheduler = self.scheduler
+        results = dict(held)
+        for rule in scheduler.plan([rule for rule in order if rule.index not in held]):
+            if (
+                not scheduler.is_overdue(rule)
+                and time.perf_counter() + scheduler.cost(rule) > deadline
+            ):
+                results[rule.index] = scheduler.defer(rule)
+                continue
+            results[rule.index] = self._evaluate(context, rule)
+        hits = []
+        for rule in order:
+            result = results.get(rule.index)
+            if result is not None and result.matched:
+                hits.append(result)
+        return hits
+
+    def _first_budgeted(
+        self,
+        context: FrameContext,
+        order: List[CompiledRule],
+        held: Dict[int, Optional[SceneMatch]],
+        deadline: float,
+    ) -> List[SceneMatch]:
+        # Walks `order` as the unbudgeted first match does, deferring rules that do not fit,
+        # and stops at the first hit. Budget left over after that goes to the rules not run
+        # this frame, stalest first, but only those with a measured cost that still fits.
+        scheduler = self.scheduler
+        results = dict(held)
+        for rule in order:
+            if rule.index not in held:
+                if (
+                    not scheduler.is_overdue(rule)
+                    and time.perf_counter() + scheduler.cost(rule) > deadline
+                ):
+                    scheduler.defer(rule)
+                    continue
+                results[rule.index] = self._evaluate(context, rule)
+            result = results[rule.index]
+            if result is not None and result.matched:
+                break
+        for rule in scheduler.plan([rule for rule in order if rule.index not in results]):
+            cost = scheduler.cost(rule)
+            if cost > 0 and time.perf_counter() + cost <= deadline:
+                results[rule.index] = self._evaluate(context, rule)
+        for rule in order:
+            result = results.get(rule.index)
+            if result is not None and result.matched:
+                return [result]
+        return []
+
+    def _evaluate_frame(
+        self,
+        context: FrameContext,
+        order: List[CompiledRule],
+        held: Dict[int, Optional[SceneMatch]],
+        max_workers: int,
+        first_only: bool,
+    ) -> List[SceneMatch]:
+        if max_workers <= 1 or len(order) - len(held) <= 1:
+            hits = []
+            for rule in order:
+                if rule.index in held:
+                    result = held[rule.index]
+                else:
+                    result = self._evaluate(context, rule)
+                if result is not None and result.matched:
+                    hits.append(result)
+                    if first_only:
+                        break
+            return hits
+
+        # Color rules are cheap, so they run as one batch job next to the templates.
+        executor = _get_executor(max_workers)
+        pending = [rule for rule in order if rule.index not in held]
+        futures = {
+            rule.index: executor.submit(self._evaluate, context, rule)
+            for rule in pending
+            if rule.type != "color"
+        }
+        color_rules = [rule for rule in pending if rule.type == "color"]
+        color_future = executor.submit(self._evaluate_many, context, color_rules)
+        hits = []
+        for rule in order:
+            if rule.index in held:
+                result = held[rule.index]
+            elif rule.type == "color":
+                result = color_future.result()[rule.index]
+            else:
+                result = futures[rule.index].result()
+            if result is not None and result.matched:
+                hits.append(result)
+                if first_only:
+                    break
+        for future in futures.values():
+            future.cancel()
+        return hits
+
+    def _record_context(self, context: FrameContext) -> None:
+        with self._debug_lock:
+            self._debug["frames"] += 1
+            self._debug["requests"] += context.requests
+            self._debug["computed"] += context.computed
+            self._debug["last_requests"] = context.requests
+            self._debug["last_computed"] = context.computed
+
+    def debug_stats(self) -> Dict[str, Any]:
+        with self._debug_lock:
+            stats: Dict[str, Any] = dict(self._debug)
+        requests = stats["requests"]
+        stats["dedup_ratio"] = 1.0 - stats["computed"] / float(requests) if requests else 0.0
+        if self.reuse:
+            stats["reuse"] = self.reuse.stats()
+        stats["schedule"] = self.scheduler.stats()
+        if any(rule.type == "text" for rule in self.rules):
+            stats["ocr"] = self._texts.stats()
+        return stats
+
+    def match(
+        self, image: np.ndarray, max_workers: int = 1, deadline: Optional[float] = None
+    ) -> Optional[str]:
+        hits = self.evaluate(image, max_workers=max_workers, first_only=True, deadline=deadline)
+        return hits[0].name if hits else None
+
+
+class StatefulSceneMatcher:
+    def __init__(
+        self,
+        rules: CompiledSceneRules,
+        transitions: Dict[str, List[str]],
+        rescan_interval: int = 30,
+        lost_timeout: float = 2.0,
+        max_workers: int = 1,
+    ):
+        self.rules = rules
+        self.transitions = transitions
+        self.rescan_interval = max(1, int(rescan_interval))
+        self.lost_timeout = max(0.0, float(lost_timeout))
+        self.max_workers = max_workers
+        self.current: Optional[str] = None
+        self.full_scans = 0
+        self.partial_scans = 0
+        self._subsets: Dict[str, CompiledSceneRules] = {}
+        self._frames_since_full = 0
+        self._last_seen_ts = 0.0
+
+    def reset(self) -> None:
+        self.current = None
+        self._frames_since_full = 0
+
+    def _candidates(self) -> Optional[CompiledSceneRules]:
+        if self.current is None or self.current not in self.transitions:
+            return None
+        subset = self._subsets.get(self.current)
+        if subset is None:
+            subset = self.rules.subset([self.current, *self.transitions[self.current]])
+            self._subsets[self.current] = subset
+        return subset
+
+    def match(self, image: np.ndarray, deadline: Optional[float] = None) -> Optional[str]:
+        now = time.monotonic()
+        candidates = self._candidates()
+        full = (
+            candidates is None
+            or self._frames_since_full >= self.rescan_interval
+            or now - self._last_seen_ts > self.lost_timeout
+        )
+        if full:
+            scene = self.rules.match(image, max_workers=self.max_workers, deadline=deadline)
+            self.full_scans += 1
+            self._frames_since_full = 0
+        else:
+            scene = candidates.match(image, max_workers=self.max_workers, deadline=deadline)
+            self.partial_scans += 1
+            self._frames_since_full += 1
+        if scene:
+            self.current = scene
+            self._last_seen_ts = now
+        return scene
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "current": self.current,
+            "full_scans": self.full_scans,
+            "partial_scans": self.partial_scans,
+        }
+
+
+def compile_scene_rules(
+    rules: List[SceneRule],
+    base_dir: Optional[str] = None,
+    log_callback: Optional[Callable[[str], None]] = None,
+) -> CompiledSceneRules:
+    compiled = []
+    leaves: Dict[str, CompiledRule] = {}
+    for index, rule in enumerate(rules):
+        item = _compile_rule(rule, index, base_dir, leaves)
+        if item:
+            compiled.append(item)
+    return CompiledSceneRules(compiled, base_dir=base_dir, log_callback=log_callback)
+
+
+def recompile_scene_rules(
+    previous: Optional[CompiledSceneRules],
+    rules: List[SceneRule],
+    base_dir: Optional[str] = None,
+) -> Tuple[CompiledSceneRules, int]:
+    reusable: Dict[str, List[CompiledRule]] = {}
+    if previous is not None and previous.base_dir == base_dir:
+        for item in previous:
+            # Composites recompile so their children get indices from this compile.
+            if "template_image" in item.rule or item.children:
+                continue
+            reusable.setdefault(_rule_key(item.rule), []).append(item)
+
+    compiled = []
+    leaves: Dict[str, CompiledRule] = {}
+    recompiled = 0
+    for index, rule in enumerate(rules):
+        candidates = reusable.get(_rule_key(rule)) if "template_image" not in rule else None
+        item = None
+        while candidates and item is None:
+            old = candidates.pop(0)
+            path = resolve_rule_template(rule, base_dir) if old.type == "template" else None
+            if old.source == file_signature(path):
+                item = replace(old, index=index, rule=rule)
+        if item is None:
+            item = _compile_rule(rule, index, base_dir, leaves)
+            recompiled += 1
+        if item:
+            compiled.append(item)
+
+    result = CompiledSceneRules(compiled, base_dir=base_dir)
+    if previous is not None:
+        result.inherit_settings(previous)
+    return result, recompiled
+
+
+def _match_template(
+    context: FrameContext, rule: CompiledRule, prefilter: Optional[StatsPrefilter] = None
+) -> Tuple[float, int, int]:
+    template = rule.template
+    if template is None:
+        return float("-inf"), rule.x, rule.y
+    roi = context.roi(rule)
     if roi.size == 0:
-        return False
+        return float("-inf"), rule.x, rule.y
     if roi.shape[0] < template.shape[0] or roi.shape[1] < template.shape[1]:
-        return False
+        return float("-inf"), rule.x, rule.y
+    boxes = [(0, 0, roi.shape[1], roi.shape[0])]
+    if prefilter is not None and rule.method == cv2.TM_CCOEFF_NORMED:
+        size = template.shape[:2]
+        bounds = _roi_bounds(rule.roi, context.image.shape)
+        integrals = context.shared(
+            ("integrals", bounds, rule.color_space, rule.scale),
+            lambda: StatsPrefilter.integrals(roi),
+        )
+        textured = context.shared(
+            ("textured", bounds, rule.color_space, rule.scale, size),
+            lambda: StatsPrefilter.textured(integrals, size),
+        )
+        boxes = prefilter.regions(textured, template)
+        if boxes is None:
+            return float("-inf"), rule.x, rule.y
+    best = float("-inf"), (0, 0)
+    for x0, y0, x1, y1 in boxes:
+        result = cv2.matchTemplate(roi[y0:y1, x0:x1], template, rule.method)
+        _, max_val, _, max_loc = cv2.minMaxLoc(result)
+        if max_val > best[0]:
+            best = float(max_val), (x0 + max_loc[0], y0 + max_loc[1])
+    score, (mx, my) = best
+    x = rule.x + int(round(mx / rule.scale))
+    y = rule.y + int(round(my / rule.scale))
+    return score, x, y
 
-    method_name = rule.get("method", "TM_CCOEFF_NORMED")
-    method = getattr(cv2, method_name, cv2.TM_CCOEFF_NORMED)
-    result = cv2.matchTemplate(roi, template, method)
-    _, max_val, _, _ = cv2.minMaxLoc(result)
-    threshold = float(rule.get("threshold", 0.9))
-    return max_val >= threshold
 
+def _evaluate_rule(
+    context: FrameContext,
+    rule: CompiledRule,
+    colors: ColorRuleBatch,
+    texts: TextRuleReader,
+    prefilter: Optional[StatsPrefilter] = None,
+) -> SceneMatch:
+    start = time.perf_counter()
+    matched = False
+    sampled = False
+    score = float("-inf")
+    x, y = rule.x, rule.y
+    if rule.type == "template":
+        score, x, y = _match_template(context, rule, prefilter)
+        matched = score >= rule.threshold
+    elif rule.type == "color":
+        score, sampled = colors.ratio(context, rule)
+        matched = score >= rule.ratio
+    elif rule.type == "text":
+        score, x, y, matched = texts.read(context, rule)
+    elapsed = time.perf_counter() - start
+    return SceneMatch(
+        rule.name, rule.index, matched, score, x, y, elapsed, sampled=sampled
+    )
+
+
+def _ensure_compiled(
+    rules: Union[List[SceneRule], CompiledSceneRules], base_dir: Optional[str]
+) -> CompiledSceneRules:
+    if isinstance(rules, CompiledSceneRules):
+        return rules
+    return compile_scene_rules(rules, base_dir=base_dir)
 
-def _match_color(image: np.ndarray, rule: SceneRule) -> bool:
-    region = rule.get("region")
-    roi, _, _ = _get_region(image, region)
-    if roi.size == 0:
-        return False
-    lower = np.array(rule.get("lower", [0, 0, 0]), dtype=np.uint8)
-    upper = np.array(rule.get("upper", [255, 255, 255]), dtype=np.uint8)
-    mask = np.all((roi >= lower) & (roi <= upper), axis=2)
-    ratio = float(rule.get("ratio", 1.0))
-    return float(mask.mean()) >= ratio
+
+def match_scene_all(
+    image: np.ndarray,
+    rules: Union[List[SceneRule], CompiledSceneRules],
+    base_dir: Optional[str] = None,
+    max_workers: int = 4,
+    deadline: Optional[float] = None,
+) -> List[SceneMatch]:
+    compiled = _ensure_compiled(rules, base_dir)
+    return compiled.evaluate(image, max_workers=max_workers, deadline=deadline)
 
 
 def match_scene(
     image: np.ndarray,
-    rules: List[SceneRule],
+    rules: Union[List[SceneRule], CompiledSceneRules],
     base_dir: Optional[str] = None,
+    max_workers: int = 1,
+    deadline: Optional[float] = None,
 ) -> Optional[str]:
-    for rule in rules:
-        name = rule.get("name")
-        rule_type = rule.get("type")
-        if not name or not rule_type:
-            continue
-        if rule_type == "template":
-            if _match_template(image, rule, base_dir):
-                return name
-        elif rule_type == "color":
-            if _match_color(image, rule):
-                return name
-    return None
+    compiled = _ensure_compiled(rules, base_dir)
+    return compiled.match(image, max_workers=max_workers, deadline=deadline)
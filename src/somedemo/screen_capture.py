@@ -5,6 +5,8 @@ from typing import Callable, Optional, Tuple
 import numpy as np
 import mss
 
+from somedemo.frame_ring import FrameRing
+
 
 FrameCallback = Callable[[np.ndarray], None]
 
@@ -16,11 +18,15 @@ class ScreenCapture:
         fps: float = 10.0,
         frame_callback: Optional[FrameCallback] = None,
         log_callback: Optional[Callable[[str], None]] = None,
+        frame_ring: Optional[FrameRing] = None,
     ):
         self.region = region
         self.fps = max(0.1, float(fps))
         self.frame_callback = frame_callback
         self.log_callback = log_callback
+        # Frames are published here once, before the callback, so process-pool matchers
+        # (match_workers) can hand them to their workers without another copy.
+        self.frame_ring = frame_ring
 
         self._running = False
         self._thread: Optional[threading.Thread] = None
@@ -78,6 +84,8 @@ class ScreenCapture:
                 frame = np.ascontiguousarray(frame)
                 with self._lock:
                     self._latest_frame = frame
+                if self.frame_ring:
+                    self.frame_ring.publish(frame)
                 if self.frame_callback:
                     self.frame_callback(frame)
 
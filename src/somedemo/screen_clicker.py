@@ -8,6 +8,8 @@ import pyautogui
 import pytesseract
 from pynput import keyboard, mouse
 
+from somedemo.text_ocr import iter_image_text_boxes
+
 
 def parse_keywords(raw: str) -> List[str]:
     parts = [p.strip() for p in raw.split(",")]
@@ -19,25 +21,8 @@ def iter_text_boxes(
     region: Optional[Tuple[int, int, int, int]],
 ) -> Iterable[Tuple[str, int, int, int, int, int]]:
     screenshot = pyautogui.screenshot(region=region)
-    data = pytesseract.image_to_data(
-        screenshot, lang=lang, output_type=pytesseract.Output.DICT
-    )
-    for i, text in enumerate(data.get("text", [])):
-        text = (text or "").strip()
-        if not text:
-            continue
-        try:
-            conf = int(float(data.get("conf", [0])[i]))
-        except (ValueError, TypeError):
-            conf = 0
-        x = int(data.get("left", [0])[i])
-        y = int(data.get("top", [0])[i])
-        w = int(data.get("width", [0])[i])
-        h = int(data.get("height", [0])[i])
-        if region:
-            x += region[0]
-            y += region[1]
-        yield text, conf, x, y, w, h
+    offset = (region[0], region[1]) if region else (0, 0)
+    return iter_image_text_boxes(screenshot, lang, offset)
 
 
 def should_click(
@@ -0,0 +1,129 @@
+import os
+import threading
+from collections import OrderedDict
+from dataclasses import dataclass
+from typing import Dict, Optional, Tuple
+
+import cv2
+import numpy as np
+
+
+CacheKey = Tuple[str, int, str]
+
+COLOR_MODES = ("bgr", "gray", "unchanged")
+
+
+@dataclass
+class _CacheEntry:
+    image: np.ndarray
+    mtime_ns: int
+    size: int
+
+
+def _decode(path: str, flags: int, color_mode: str) -> Optional[np.ndarray]:
+    image = cv2.imread(path, flags)
+    if image is None:
+        return None
+    if color_mode == "bgr":
+        if image.ndim == 3 and image.shape[2] == 4:
+            image = cv2.cvtColor(image, cv2.COLOR_BGRA2BGR)
+    elif color_mode == "gray":
+        if image.ndim == 3 and image.shape[2] == 4:
+            image = cv2.cvtColor(image, cv2.COLOR_BGRA2GRAY)
+        elif image.ndim == 3:
+            image = cv2.cvtColor(image, cv2.COLOR_BGR2GRAY)
+    return image
+
+
+class TemplateCache:
+    def __init__(self, max_bytes: int = 256 * 1024 * 1024):
+        self.max_bytes = max(0, int(max_bytes))
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._entries: "OrderedDict[CacheKey, _CacheEntry]" = OrderedDict()
+        self._bytes = 0
+        self._lock = threading.Lock()
+
+    def get(
+        self, path: str, flags: int = cv2.IMREAD_COLOR, color_mode: str = "bgr"
+    ) -> Optional[np.ndarray]:
+        if color_mode not in COLOR_MODES:
+            raise ValueError(f"color_mode must be one of {COLOR_MODES}")
+        key = (os.path.abspath(path), int(flags), color_mode)
+        try:
+            stat = os.stat(path)
+        except OSError:
+            with self._lock:
+                self._drop(key)
+            return None
+        with self._lock:
+            entry = self._entries.get(key)
+            if (
+                entry is not None
+                and entry.mtime_ns == stat.st_mtime_ns
+                and entry.size == stat.st_size
+            ):
+                self._entries.move_to_end(key)
+                self.hits += 1
+                return entry.image
+            self.misses += 1
+
+        image = _decode(path, flags, color_mode)
+        if image is not None:
+            # Shared by every caller and keyed by id() in derived caches; never edit in place.
+            image.flags.writeable = False
+        with self._lock:
+            self._drop(key)
+            if image is None:
+                return None
+            if image.nbytes <= self.max_bytes:
+                self._entries[key] = _CacheEntry(image, stat.st_mtime_ns, stat.st_size)
+                self._bytes += image.nbytes
+                self._evict()
+        return image
+
+    def set_max_bytes(self, max_bytes: int) -> None:
+        with self._lock:
+            self.max_bytes = max(0, int(max_bytes))
+            self._evict()
+
+    def clear(self) -> None:
+        with self._lock:
+            self._entries.clear()
+            self._bytes = 0
+
+    def stats(self) -> Dict[str, int]:
+        with self._lock:
+            return {
+                "hits": self.hits,
+                "misses": self.misses,
+                "evictions": self.evictions,
+                "entries": len(self._entries),
+                "bytes": self._bytes,
+                "max_bytes": self.max_bytes,
+            }
+
+    def _drop(self, key: CacheKey) -> None:
+        entry = self._entries.pop(key, None)
+        if entry is not None:
+            self._bytes -= entry.image.nbytes
+
+    def _evict(self) -> None:
+        while self._entries and self._bytes > self.max_bytes:
+            _, entry = self._entries.popitem(last=False)
+            self._bytes -= entry.image.nbytes
+            self.evictions += 1
+
+
+_default_cache = TemplateCache()
+
+
+def get_template_cache() -> TemplateCache:
+    return _default_cache
+
+
+def load_image(
+    path: str, flags: int = cv2.IMREAD_COLOR, color_mode: str = "bgr"
+) -> Optional[np.ndarray]:
+    return _default_cache.get(path, flags, color_mode)
@@ -1,41 +1,93 @@
 import json
 import os
-from typing import Any, Dict, List, Optional
+from typing import Any, Dict, List, Optional, Tuple
 
 import cv2
 import numpy as np
 
+from somedemo.bundle import is_bundle, read_bundle
+from somedemo.template_cache import load_image
+from somedemo.template_search import (
+    DEFAULT_SCALES,
+    FftCorrelator,
+    FrameSearch,
+    LocationTracker,
+    ParallelSearch,
+    PyramidSearch,
+    ScaledResult,
+    ScaleBank,
+    StatsPrefilter,
+    check_match_mode,
+    convert_image,
+    load_meta,
+    local_peaks,
+    non_max_suppression,
+    prepare_template,
+)
+
 
 TemplateConfig = Dict[str, Any]
 MatchResult = Dict[str, Any]
+MatchMode = Tuple[str, float]
+MODE_KEYS = ("color_mode", "scale")
 
 
 class TemplateMatcher:
     def __init__(self, templates: List[TemplateConfig]):
+        for tmpl in templates:
+            if any(key in tmpl for key in MODE_KEYS):
+                check_match_mode(tmpl.get("color_mode", "bgr"), tmpl.get("scale", 1.0))
         self._templates = templates
+        self.color_mode = "bgr"
+        self.scale = 1.0
+        self.pyramid: Optional[PyramidSearch] = None
+        self.scales: Optional[ScaleBank] = None
+        self.tracker: Optional[LocationTracker] = None
+        self.prefilter: Optional[StatsPrefilter] = None
+        self.fft: Optional[FftCorrelator] = None
+        self.parallel: Optional[ParallelSearch] = None
+
+    @property
+    def templates(self) -> List[TemplateConfig]:
+        return list(self._templates)
 
-    def describe(self) -> List[Dict[str, int]]:
-        summary: List[Dict[str, int]] = []
+    def describe(self) -> List[Dict[str, Any]]:
+        summary: List[Dict[str, Any]] = []
         for tmpl in self._templates:
             image = tmpl.get("image")
             if image is None:
                 continue
+            color_mode, scale = self._mode(tmpl)
             summary.append(
                 {
                     "name": str(tmpl.get("name", "")),
                     "width": int(image.shape[1]),
                     "height": int(image.shape[0]),
+                    "color_mode": color_mode,
+                    "scale": scale,
                 }
             )
         return summary
 
+    def set_match_mode(self, color_mode: str = "bgr", scale: float = 1.0) -> None:
+        # Default for templates without their own "color_mode" / "scale". Gray and single
+        # channel modes correlate one plane instead of three; scale < 1 matches downscaled
+        # frames and templates. Results stay in full-resolution frame coordinates.
+        self.color_mode, self.scale = check_match_mode(color_mode, scale)
+
+    def _mode(self, tmpl: TemplateConfig) -> MatchMode:
+        return (
+            str(tmpl.get("color_mode", self.color_mode)).lower(),
+            float(tmpl.get("scale", self.scale)),
+        )
+
     @classmethod
     def load_from_paths(
         cls, paths: List[str], threshold: float = 0.85
     ) -> "TemplateMatcher":
         templates = []
         for path in paths:
-            image = cv2.imread(path, cv2.IMREAD_COLOR)
+            image = load_image(path, cv2.IMREAD_COLOR)
             if image is None:
                 continue
             name = os.path.splitext(os.path.basename(path))[0]
@@ -45,12 +97,16 @@ class TemplateMatcher:
                     "image": image,
                     "threshold": float(threshold),
                     "click": {},
+                    "path": path,
+                    "meta": load_meta(os.path.splitext(path)[0] + ".json"),
                 }
             )
         return cls(templates)
 
     @classmethod
     def load_from_json(cls, path: str) -> "TemplateMatcher":
+        if is_bundle(path):
+            return cls.load_from_bundle(path)
         with open(path, "r", encoding="utf-8") as f:
             data = json.load(f)
         templates = []
@@ -65,37 +121,295 @@ class TemplateMatcher:
                 if os.path.isabs(path_value)
                 else os.path.join(base_dir, path_value)
             )
-            image = cv2.imread(template_path, cv2.IMREAD_COLOR)
+            image = load_image(template_path, cv2.IMREAD_COLOR)
             if image is None:
                 continue
-            templates.append(
-                {
-                    "name": name,
-                    "image": image,
-                    "threshold": float(item.get("threshold", 0.85)),
-                    "click": dict(item.get("click", {})),
-                }
-            )
+            tmpl = {
+                "name": name,
+                "image": image,
+                "threshold": float(item.get("threshold", 0.85)),
+                "click": dict(item.get("click", {})),
+                "path": template_path,
+                "meta": dict(
+                    item.get("meta") or load_meta(os.path.splitext(template_path)[0] + ".json")
+                ),
+            }
+            tmpl.update({key: item[key] for key in MODE_KEYS if key in item})
+            templates.append(tmpl)
         return cls(templates)
 
+    @classmethod
+    def load_from_bundle(cls, path: str, threshold: float = 0.85) -> "TemplateMatcher":
+        templates = []
+        for item in read_bundle(path).templates():
+            tmpl = {
+                "name": item["name"],
+                "image": item["image"],
+                "threshold": float(item.get("threshold", threshold)),
+                "click": dict(item.get("click", {})),
+                "path": item.get("path", ""),
+                "meta": dict(item.get("meta", {})),
+            }
+            tmpl.update({key: item[key] for key in MODE_KEYS if key in item})
+            templates.append(tmpl)
+        return cls(templates)
+
+    def enable_pyramid(
+        self, levels: int = 2, reject_margin: float = 0.25, min_fidelity: float = 0.9
+    ) -> PyramidSearch:
+        self.pyramid = PyramidSearch(
+            levels=levels, reject_margin=reject_margin, min_fidelity=min_fidelity
+        )
+        return self.pyramid
+
+    def enable_multiscale(
+        self,
+        screen_scale: Tuple[float, float] = (1.0, 1.0),
+        scales: Tuple[float, ...] = DEFAULT_SCALES,
+        max_candidates: int = 3,
+    ) -> ScaleBank:
+        self.scales = ScaleBank(scales, max_candidates=max_candidates)
+        self.scales.set_current_scale(*screen_scale)
+        return self.scales
+
+    def enable_tracking(
+        self,
+        margin: float = 1.0,
+        rescan_interval: int = 30,
+        frame_origin: Tuple[int, int] = (0, 0),
+    ) -> LocationTracker:
+        self.tracker = LocationTracker(margin=margin, rescan_interval=rescan_interval)
+        self.tracker.set_frame_origin(*frame_origin)
+        return self.tracker
+
+    def enable_prefilter(self) -> StatsPrefilter:
+        self.prefilter = StatsPrefilter()
+        return self.prefilter
+
+    def enable_fft_batching(self, min_group: int = 2, cache_mb: float = 256.0) -> FftCorrelator:
+        self.fft = FftCorrelator(min_group=min_group, cache_mb=cache_mb)
+        return self.fft
+
+    def enable_parallel(self, workers: int = 4, certain: Optional[float] = 0.99) -> ParallelSearch:
+        # Once a template scores `certain`, later templates in the list are skipped; the
+        # result is the same as a serial scan that stops there.
+        self.parallel = ParallelSearch(workers=workers, certain=certain)
+        return self.parallel
+
+    def export_settings(self) -> Dict[str, Any]:
+        # Plain-data form of the configuration above, for rebuilding a matcher elsewhere
+        # (see match_workers). The thread pool is left out.
+        settings: Dict[str, Any] = {"color_mode": self.color_mode, "scale": self.scale}
+        if self.pyramid:
+            settings["pyramid"] = (
+                self.pyramid.levels,
+                self.pyramid.reject_margin,
+                self.pyramid.min_fidelity,
+            )
+        if self.scales:
+            settings["multiscale"] = (
+                self.scales.current_scale,
+                self.scales.scales,
+                self.scales.max_candidates,
+            )
+        if self.tracker:
+            settings["tracking"] = (
+                self.tracker.margin,
+                self.tracker.rescan_interval,
+                self.tracker.frame_origin,
+            )
+        if self.prefilter:
+            settings["prefilter"] = True
+        if self.fft:
+            settings["fft_batching"] = (self.fft.min_group, self.fft.cache_mb)
+        return settings
+
+    def apply_settings(self, settings: Dict[str, Any]) -> None:
+        self.set_match_mode(settings.get("color_mode", "bgr"), settings.get("scale", 1.0))
+        if "pyramid" in settings:
+            self.enable_pyramid(*settings["pyramid"])
+        if "multiscale" in settings:
+            self.enable_multiscale(*settings["multiscale"])
+        if "tracking" in settings:
+            self.enable_tracking(*settings["tracking"])
+        if "prefilter" in settings:
+            self.enable_prefilter()
+        if "fft_batching" in settings:
+            self.enable_fft_batching(*settings["fft_batching"])
+
+    def inherit_settings(self, previous: "TemplateMatcher") -> None:
+        # Shared, so remembered winning scales, last locations and stats survive a reload.
+        self.pyramid = previous.pyramid
+        self.scales = previous.scales
+        self.tracker = previous.tracker
+        self.prefilter = previous.prefilter
+        self.fft = previous.fft
+        self.parallel = previous.parallel
+        self.color_mode = previous.color_mode
+        self.scale = previous.scale
+
+    @staticmethod
+    def _view(search: FrameSearch, mode: MatchMode) -> FrameSearch:
+        # The frame converted for a matching mode, built once per frame and shared by every
+        # template using that mode.
+        if mode == ("bgr", 1.0):
+            return search
+        return search.shared(
+            ("view",) + mode,
+            lambda: FrameSearch(
+                convert_image(search.image, *mode), search.pyramid, search.prefilter
+            ),
+        )
+
+    @staticmethod
+    def _full_resolution(found: ScaledResult, scale: float) -> ScaledResult:
+        score, (x, y), template = found
+        return score, (int(round(x / scale)), int(round(y / scale))), template
+
+    def _search(self, tmpl: TemplateConfig, search: FrameSearch) -> Optional[ScaledResult]:
+        template = tmpl["image"]
+        color_mode, scale = mode = self._mode(tmpl)
+        view = self._view(search, mode)
+        if self.scales:
+            found = self.scales.search(
+                tmpl["name"],
+                tmpl.get("meta", {}),
+                view,
+                template,
+                tmpl["threshold"],
+                lambda image: prepare_template(image, color_mode, scale),
+            )
+            return self._full_resolution(found, scale)
+        probe = prepare_template(template, color_mode, scale)
+        if not view.fits(probe):
+            return None
+        max_val, max_loc = view.search(probe, tmpl["threshold"])
+        return self._full_resolution((max_val, max_loc, template), scale)
+
+    def _window_search(self, image: np.ndarray) -> FrameSearch:
+        # Tracking windows are small enough that a pyramid would not pay off.
+        return FrameSearch(image, prefilter=self.prefilter)
+
+    def _fft_groups(self, search: FrameSearch) -> List[Tuple[MatchMode, List[int]]]:
+        # Templates sharing a matching mode and size are correlated together against one frame
+        # spectrum; groups smaller than min_group, and everything else, take the per-template
+        # path.
+        groups: Dict[Tuple[Any, ...], Tuple[MatchMode, List[int]]] = {}
+        for index, tmpl in enumerate(self._templates):
+            mode = self._mode(tmpl)
+            probe = prepare_template(tmpl["image"], *mode)
+            if self._view(search, mode).fits(probe):
+                groups.setdefault(mode + probe.shape, (mode, []))[1].append(index)
+        return [group for group in groups.values() if len(group[1]) >= self.fft.min_group]
+
+    def _fft_probes(self, mode: MatchMode, indices: List[int]) -> List[np.ndarray]:
+        return [prepare_template(self._templates[i]["image"], *mode) for i in indices]
+
+    def _batched(self, search: FrameSearch) -> Dict[int, ScaledResult]:
+        results: Dict[int, ScaledResult] = {}
+        for mode, indices in self._fft_groups(search):
+            view = self._view(search, mode)
+            found = self.fft.search_group(view, self._fft_probes(mode, indices))
+            for index, (max_val, max_loc) in zip(indices, found):
+                template = self._templates[index]["image"]
+                results[index] = self._full_resolution((max_val, max_loc, template), mode[1])
+        return results
+
     def match(self, frame: np.ndarray) -> Optional[MatchResult]:
+        found = self.match_with_index(frame)
+        return found[1] if found else None
+
+    def match_with_index(self, frame: np.ndarray) -> Optional[Tuple[int, MatchResult]]:
+        # Like match, plus the winning template's position in the list.
         best = None
-        for tmpl in self._templates:
-            template = tmpl["image"]
-            if frame.shape[0] < template.shape[0] or frame.shape[1] < template.shape[1]:
+        search = FrameSearch(frame, self.pyramid, self.prefilter)
+        batched = self._batched(search) if self.fft else {}
+
+        def run(index: int) -> Optional[ScaledResult]:
+            tmpl = self._templates[index]
+            if index in batched:
+                return batched[index]
+            if self.tracker:
+                return self.tracker.search(
+                    tmpl["name"],
+                    tmpl.get("meta", {}),
+                    frame,
+                    tmpl["image"],
+                    tmpl["threshold"],
+                    lambda image, windowed: self._search(
+                        tmpl, self._window_search(image) if windowed else search
+                    ),
+                )
+            return self._search(tmpl, search)
+
+        if self.parallel:
+            names = [tmpl["name"] for tmpl in self._templates]
+            results = self.parallel.run(names, run, self.parallel.certain)
+        else:
+            results = [run(index) for index in range(len(self._templates))]
+        for index, (tmpl, found) in enumerate(zip(self._templates, results)):
+            if found is None:
                 continue
-            result = cv2.matchTemplate(frame, template, cv2.TM_CCOEFF_NORMED)
-            _, max_val, _, max_loc = cv2.minMaxLoc(result)
+            max_val, max_loc, template = found
             if max_val < tmpl["threshold"]:
                 continue
-            if not best or max_val > best["confidence"]:
-                best = {
-                    "name": tmpl["name"],
-                    "confidence": float(max_val),
-                    "x": int(max_loc[0]),
-                    "y": int(max_loc[1]),
-                    "width": int(template.shape[1]),
-                    "height": int(template.shape[0]),
-                    "click": dict(tmpl.get("click", {})),
-                }
+            if not best or max_val > best[1]["confidence"]:
+                best = index, self._result(tmpl, max_val, max_loc, template)
         return best
+
+    @staticmethod
+    def _result(
+        tmpl: TemplateConfig, confidence: float, location: Tuple[int, int], template: np.ndarray
+    ) -> MatchResult:
+        return {
+            "name": tmpl["name"],
+            "confidence": float(confidence),
+            "x": int(location[0]),
+            "y": int(location[1]),
+            "width": int(template.shape[1]),
+            "height": int(template.shape[0]),
+            "click": dict(tmpl.get("click", {})),
+        }
+
+    def match_all(
+        self, frame: np.ndarray, iou: float = 0.3, max_results: int = 20
+    ) -> List[MatchResult]:
+        # Every instance above threshold, strongest first, from one correlation map per
+        # template. Boxes overlapping a stronger one by more than `iou` are dropped, first
+        # within each template and then across templates.
+        search = FrameSearch(frame, prefilter=self.prefilter)
+        maps: Dict[int, Tuple[np.ndarray, Tuple[int, int]]] = {}
+        if self.fft:
+            for mode, indices in self._fft_groups(search):
+                view = self._view(search, mode)
+                for index, scores in zip(
+                    indices, self.fft.correlate(view, self._fft_probes(mode, indices))
+                ):
+                    maps[index] = (scores, (0, 0))
+
+        results: List[MatchResult] = []
+        for index, tmpl in enumerate(self._templates):
+            template = tmpl["image"]
+            mode = self._mode(tmpl)
+            scored = maps.get(index)
+            if scored is None:
+                view = self._view(search, mode)
+                probe = prepare_template(template, *mode)
+                scored = view.score_map(probe) if view.fits(probe) else None
+            if scored is None:
+                continue
+            scores, offset = scored
+            scale = mode[1]
+            peaks = [
+                (score, (int(round(x / scale)), int(round(y / scale))))
+                for score, (x, y) in local_peaks(scores, tmpl["threshold"], offset)
+            ]
+            height, width = template.shape[:2]
+            boxes = [(x, y, x + width, y + height) for _, (x, y) in peaks]
+            scores_only = [score for score, _ in peaks]
+            for i in non_max_suppression(boxes, scores_only, iou, max_results):
+                results.append(self._result(tmpl, peaks[i][0], peaks[i][1], template))
+
+        boxes = [(r["x"], r["y"], r["x"] + r["width"], r["y"] + r["height"]) for r in results]
+        keep = non_max_suppression(boxes, [r["confidence"] for r in results], iou, max_results)
+        return [results[i] for i in keep]
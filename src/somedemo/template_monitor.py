@@ -4,19 +4,34 @@ import os
 import sys
 import time
 from dataclasses import dataclass
-from typing import Callable, Dict, List, Optional, Tuple
+from typing import Callable, Dict, Iterable, List, Optional, Tuple
 
 import cv2
 import mss
 import numpy as np
 import pyautogui
 
+from somedemo.bundle import read_bundle
 from somedemo.region_selector import (
     get_monitor_scale_for_region,
     get_screen_debug_info,
     physical_to_logical_region,
     select_region,
 )
+from somedemo.template_cache import load_image
+from somedemo.template_search import (
+    DEFAULT_SCALES,
+    FrameSearch,
+    LocationTracker,
+    ParallelSearch,
+    PyramidSearch,
+    ScaledResult,
+    ScaleBank,
+    StatsPrefilter,
+    load_meta,
+    local_peaks,
+    non_max_suppression,
+)
 
 
 def ensure_dpi_aware() -> None:
@@ -138,6 +153,7 @@ def capture_program_template(
         "height": int(image.shape[0]),
         "screen_resolution": [int(screen_w), int(screen_h)],
         "dpi_scale": [float(scale_x), float(scale_y)],
+        "capture_region": [int(v) for v in region],
     }
     with open(meta_path, "w", encoding="utf-8") as f:
         json.dump(meta, f, indent=2)
@@ -147,7 +163,7 @@ def capture_program_template(
 
 
 def _load_template_image(path: str, logger: Optional[Callable[[str], None]]) -> Optional[np.ndarray]:
-    image = cv2.imread(path, cv2.IMREAD_COLOR)
+    image = load_image(path, cv2.IMREAD_COLOR)
     if image is None:
         _log(f"Failed to load image: {path}", logger)
         return None
@@ -163,19 +179,6 @@ def _load_template_image(path: str, logger: Optional[Callable[[str], None]]) ->
     return image
 
 
-def _load_meta(path: str) -> Dict[str, object]:
-    if not os.path.exists(path):
-        return {}
-    try:
-        with open(path, "r", encoding="utf-8") as f:
-            data = json.load(f)
-        if isinstance(data, dict):
-            return data
-    except Exception:
-        return {}
-    return {}
-
-
 def load_template_item(
     path: str, source: str, logger: Optional[Callable[[str], None]]
 ) -> Optional[TemplateItem]:
@@ -184,7 +187,7 @@ def load_template_item(
         return None
 
     meta_path = os.path.splitext(path)[0] + ".json"
-    meta = _load_meta(meta_path)
+    meta = load_meta(meta_path)
     if not meta:
         meta = {}
 
@@ -194,11 +197,15 @@ def load_template_item(
             logger,
         )
 
+    gray = load_image(path, cv2.IMREAD_COLOR, "gray")
+    if gray is None:
+        gray = _to_gray(image)
+
     name = os.path.splitext(os.path.basename(path))[0]
     return TemplateItem(
         name=name,
         image=image,
-        gray=_to_gray(image),
+        gray=gray,
         source=source,
         meta=meta,
         path=path,
@@ -210,6 +217,38 @@ class TemplateManager:
         self._templates: List[TemplateItem] = []
         self.threshold = max(0.9, min(1.0, float(threshold)))
         self.logger = logger
+        self.pyramid: Optional[PyramidSearch] = None
+        self.scales: Optional[ScaleBank] = None
+        self.tracker: Optional[LocationTracker] = None
+        self.prefilter: Optional[StatsPrefilter] = None
+        self.parallel: Optional[ParallelSearch] = None
+
+    def enable_pyramid(
+        self, levels: int = 2, reject_margin: float = 0.25, min_fidelity: float = 0.9
+    ) -> PyramidSearch:
+        self.pyramid = PyramidSearch(
+            levels=levels, reject_margin=reject_margin, min_fidelity=min_fidelity
+        )
+        return self.pyramid
+
+    def enable_multiscale(
+        self, scales: Tuple[float, ...] = DEFAULT_SCALES, max_candidates: int = 3
+    ) -> ScaleBank:
+        self.scales = ScaleBank(scales, max_candidates=max_candidates)
+        return self.scales
+
+    def enable_tracking(self, margin: float = 1.0, rescan_interval: int = 30) -> LocationTracker:
+        self.tracker = LocationTracker(margin=margin, rescan_interval=rescan_interval)
+        return self.tracker
+
+    def enable_prefilter(self) -> StatsPrefilter:
+        self.prefilter = StatsPrefilter()
+        return self.prefilter
+
+    def enable_parallel(self, workers: int = 4) -> ParallelSearch:
+        # match_frame stops at the first hit in priority order, so no `certain` level here.
+        self.parallel = ParallelSearch(workers=workers, certain=None)
+        return self.parallel
 
     def add(self, item: TemplateItem) -> None:
         self._templates.append(item)
@@ -226,6 +265,19 @@ class TemplateManager:
             if item:
                 self.add(item)
 
+    def load_bundle(self, path: str) -> None:
+        for entry in read_bundle(path).templates():
+            self.add(
+                TemplateItem(
+                    name=entry["name"],
+                    image=entry["image"],
+                    gray=entry["gray"],
+                    source=entry.get("source", "program_capture"),
+                    meta=dict(entry.get("meta", {})),
+                    path=entry.get("path", ""),
+                )
+            )
+
     def iter_by_priority(self) -> List[TemplateItem]:
         # Program capture templates are preferred for DPI-accurate matching.
         priority = {"program_capture": 0, "local_image": 1}
@@ -235,32 +287,112 @@ class TemplateManager:
         )
 
 
+def _search_item(
+    tmpl: TemplateItem, search: FrameSearch, threshold: float, scales: Optional[ScaleBank]
+) -> Optional[ScaledResult]:
+    if scales:
+        return scales.search(tmpl.name, tmpl.meta, search, tmpl.gray, threshold)
+    if not search.fits(tmpl.gray):
+        return None
+    max_val, max_loc = search.search(tmpl.gray, threshold)
+    return max_val, max_loc, tmpl.gray
+
+
 def match_frame(
-    frame: np.ndarray, templates: List[TemplateItem], threshold: float
+    frame: np.ndarray,
+    templates: List[TemplateItem],
+    threshold: float,
+    pyramid: Optional[PyramidSearch] = None,
+    scales: Optional[ScaleBank] = None,
+    tracker: Optional[LocationTracker] = None,
+    prefilter: Optional[StatsPrefilter] = None,
+    parallel: Optional[ParallelSearch] = None,
 ) -> Optional[Dict[str, object]]:
     frame_gray = _to_gray(frame)
-    for tmpl in templates:
-        if (
-            frame_gray.shape[0] < tmpl.gray.shape[0]
-            or frame_gray.shape[1] < tmpl.gray.shape[1]
-        ):
+    search = FrameSearch(frame_gray, pyramid, prefilter)
+
+    def run(index: int) -> Optional[ScaledResult]:
+        tmpl = templates[index]
+        if tracker:
+            return tracker.search(
+                tmpl.name,
+                tmpl.meta,
+                frame_gray,
+                tmpl.gray,
+                threshold,
+                lambda image, windowed: _search_item(
+                    tmpl,
+                    FrameSearch(image, prefilter=prefilter) if windowed else search,
+                    threshold,
+                    scales,
+                ),
+            )
+        return _search_item(tmpl, search, threshold, scales)
+
+    results: Iterable[Optional[ScaledResult]]
+    if parallel:
+        # The first hit in priority order wins, so later templates are cancelled on any hit.
+        results = parallel.run([tmpl.name for tmpl in templates], run, threshold)
+    else:
+        results = (run(index) for index in range(len(templates)))
+    for tmpl, found in zip(templates, results):
+        if found is None:
             continue
-        result = cv2.matchTemplate(frame_gray, tmpl.gray, cv2.TM_CCOEFF_NORMED)
-        _, max_val, _, max_loc = cv2.minMaxLoc(result)
+        max_val, max_loc, gray = found
         if float(max_val) >= threshold:
             return {
                 "name": tmpl.name,
                 "confidence": float(max_val),
                 "x": int(max_loc[0]),
                 "y": int(max_loc[1]),
-                "width": int(tmpl.gray.shape[1]),
-                "height": int(tmpl.gray.shape[0]),
+                "width": int(gray.shape[1]),
+                "height": int(gray.shape[0]),
                 "source": tmpl.source,
                 "path": tmpl.path,
             }
     return None
 
 
+def match_frame_all(
+    frame: np.ndarray,
+    templates: List[TemplateItem],
+    threshold: float,
+    prefilter: Optional[StatsPrefilter] = None,
+    iou: float = 0.3,
+    max_results: int = 20,
+) -> List[Dict[str, object]]:
+    # All instances from one correlation map per template; unlike match_frame, every
+    # template is searched and overlapping hits keep the strongest (earlier on ties).
+    frame_gray = _to_gray(frame)
+    search = FrameSearch(frame_gray, prefilter=prefilter)
+    matches: List[Dict[str, object]] = []
+    boxes: List[Tuple[int, int, int, int]] = []
+    for tmpl in templates:
+        scored = search.score_map(tmpl.gray) if search.fits(tmpl.gray) else None
+        if scored is None:
+            continue
+        peaks = local_peaks(scored[0], threshold, scored[1])
+        height, width = tmpl.gray.shape[:2]
+        item_boxes = [(x, y, x + width, y + height) for _, (x, y) in peaks]
+        scores = [score for score, _ in peaks]
+        for i in non_max_suppression(item_boxes, scores, iou, max_results):
+            boxes.append(item_boxes[i])
+            matches.append(
+                {
+                    "name": tmpl.name,
+                    "confidence": peaks[i][0],
+                    "x": peaks[i][1][0],
+                    "y": peaks[i][1][1],
+                    "width": int(width),
+                    "height": int(height),
+                    "source": tmpl.source,
+                    "path": tmpl.path,
+                }
+            )
+    keep = non_max_suppression(boxes, [float(m["confidence"]) for m in matches], iou, max_results)
+    return [matches[i] for i in keep]
+
+
 def click_match_center(
     match: Dict[str, object], region: Optional[Tuple[int, int, int, int]]
 ) -> None:
@@ -278,15 +410,38 @@ def monitor_and_click(
     region: Optional[Tuple[int, int, int, int]],
     manager: TemplateManager,
     fps: float = 2.0,
+    click_all: bool = False,
 ) -> None:
     ensure_dpi_aware()
     _warn_if_env_mismatch(manager.iter_by_priority(), region, manager.logger)
+    if manager.scales:
+        manager.scales.set_current_scale(
+            *get_monitor_scale_for_region(region or _get_full_screen())
+        )
+    if manager.tracker:
+        manager.tracker.set_frame_origin(*(region or _get_full_screen())[:2])
     fps = max(0.1, float(fps))
     interval = 1.0 / fps
     while True:
         start = time.perf_counter()
         frame = _capture_region(region) if region else _capture_region(_get_full_screen())
-        match = match_frame(frame, manager.iter_by_priority(), manager.threshold)
+        if click_all:
+            for match in match_frame_all(
+                frame, manager.iter_by_priority(), manager.threshold, manager.prefilter
+            ):
+                click_match_center(match, region)
+            time.sleep(max(0.0, interval - (time.perf_counter() - start)))
+            continue
+        match = match_frame(
+            frame,
+            manager.iter_by_priority(),
+            manager.threshold,
+            manager.pyramid,
+            manager.scales,
+            manager.tracker,
+            manager.prefilter,
+            manager.parallel,
+        )
         if match:
             click_match_center(match, region)
         elapsed = time.perf_counter() - start
@@ -325,6 +480,11 @@ def main() -> None:
         default=[],
         help="Program-captured template image paths (png).",
     )
+    parser.add_argument(
+        "--bundle",
+        default=None,
+        help="Template bundle built with python -m somedemo.bundle.",
+    )
     parser.add_argument(
         "--threshold",
         type=float,
@@ -337,6 +497,38 @@ def main() -> None:
         help="Select monitoring region on screen.",
     )
     parser.add_argument("--fps", type=float, default=2.0, help="Monitor FPS.")
+    parser.add_argument(
+        "--multiscale",
+        action="store_true",
+        help="Also search rescaled template variants (for DPI/resolution changes).",
+    )
+    parser.add_argument(
+        "--track",
+        action="store_true",
+        help="Search around the last hit (or the capture location) before the full frame.",
+    )
+    parser.add_argument(
+        "--prefilter",
+        action="store_true",
+        help="Skip flat windows, which cannot match, before correlating.",
+    )
+    parser.add_argument(
+        "--pyramid-levels",
+        type=int,
+        default=0,
+        help="Coarse-to-fine levels (1 = 1/2 scale, 2 = 1/4 scale); 0 matches at full resolution.",
+    )
+    parser.add_argument(
+        "--workers",
+        type=int,
+        default=0,
+        help="Match templates on this many threads (0 = serial).",
+    )
+    parser.add_argument(
+        "--click-all",
+        action="store_true",
+        help="Click every non-overlapping match found in a frame, not just the first.",
+    )
     args = parser.parse_args()
 
     if args.capture_template:
@@ -345,6 +537,18 @@ def main() -> None:
 
     region = select_region() if args.select_region else None
     manager = TemplateManager(threshold=args.threshold)
+    if args.pyramid_levels > 0:
+        manager.enable_pyramid(args.pyramid_levels)
+    if args.multiscale:
+        manager.enable_multiscale()
+    if args.track:
+        manager.enable_tracking()
+    if args.prefilter:
+        manager.enable_prefilter()
+    if args.workers > 0:
+        manager.enable_parallel(args.workers)
+    if args.bundle:
+        manager.load_bundle(args.bundle)
     if args.program_templates:
         manager.load_program_captures(args.program_templates)
     if args.templates:
@@ -353,7 +557,7 @@ def main() -> None:
         print("No templates loaded.")
         return
 
-    monitor_and_click(region, manager, fps=args.fps)
+    monitor_and_click(region, manager, fps=args.fps, click_all=args.click_all)
 
 
 if __name__ == "__main__":
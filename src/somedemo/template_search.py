@@ -0,0 +1,887 @@
+import json
+import os
+import threading
+import time
+import weakref
+from collections import OrderedDict
+from concurrent.futures import Future, ThreadPoolExecutor, as_completed
+from typing import Any, Callable, Dict, Iterator, List, Optional, Tuple, TypeVar
+
+import cv2
+import numpy as np
+
+
+Location = Tuple[int, int]
+SearchResult = Tuple[float, Location]
+ScaledResult = Tuple[float, Location, np.ndarray]
+Box = Tuple[int, int, int, int]
+T = TypeVar("T")
+
+
+class DerivedTemplates:
+    # Derived variants (downscaled, converted, ...) keyed by the identity of the source array;
+    # entries are dropped when the source array is garbage collected.
+    def __init__(self) -> None:
+        self._entries: Dict[int, Dict[Any, np.ndarray]] = {}
+        self._lock = threading.Lock()
+
+    def get(self, source: np.ndarray, key: Any, build: Callable[[], np.ndarray]) -> np.ndarray:
+        source_id = id(source)
+        with self._lock:
+            variants = self._entries.get(source_id)
+            if variants is not None and key in variants:
+                return variants[key]
+        value = build()
+        with self._lock:
+            variants = self._entries.get(source_id)
+            if variants is None:
+                variants = self._entries[source_id] = {}
+                weakref.finalize(source, self._forget, source_id)
+            return variants.setdefault(key, value)
+
+    def _forget(self, source_id: int) -> None:
+        with self._lock:
+            self._entries.pop(source_id, None)
+
+
+_derived = DerivedTemplates()
+
+
+def derived_template(source: np.ndarray, key: Any, build: Callable[[], np.ndarray]) -> np.ndarray:
+    return _derived.get(source, key, build)
+
+
+def halve(image: np.ndarray, times: int = 1) -> np.ndarray:
+    for _ in range(times):
+        size = (max(1, image.shape[1] // 2), max(1, image.shape[0] // 2))
+        image = cv2.resize(image, size, interpolation=cv2.INTER_AREA)
+    return image
+
+
+def match_full(image: np.ndarray, template: np.ndarray) -> SearchResult:
+    result = cv2.matchTemplate(image, template, cv2.TM_CCOEFF_NORMED)
+    _, max_val, _, max_loc = cv2.minMaxLoc(result)
+    return float(max_val), (int(max_loc[0]), int(max_loc[1]))
+
+
+def _peaks(result: np.ndarray, count: int, radius: Tuple[int, int]) -> List[SearchResult]:
+    peaks = []
+    rx, ry = radius
+    for _ in range(count):
+        _, max_val, _, max_loc = cv2.minMaxLoc(result)
+        if not np.isfinite(max_val):
+            break
+        peaks.append((float(max_val), (int(max_loc[0]), int(max_loc[1]))))
+        x, y = max_loc
+        result[max(0, y - ry) : y + ry + 1, max(0, x - rx) : x + rx + 1] = -np.inf
+    return peaks
+
+
+def local_peaks(
+    scores: np.ndarray, threshold: float, offset: Location = (0, 0)
+) -> List[SearchResult]:
+    # Every 3x3 local maximum at or above threshold, strongest first. Neighbouring local
+    # maxima are equal, so each 8-connected plateau (a flat template scores 1.0 everywhere)
+    # is reported once, at its first pixel in raster order.
+    mask = ((scores >= threshold) & (scores >= cv2.dilate(scores, None))).astype(np.uint8)
+    _, labels = cv2.connectedComponents(mask, connectivity=8)
+    ys, xs = np.nonzero(mask)
+    _, first = np.unique(labels[ys, xs], return_index=True)
+    ys, xs = ys[first], xs[first]
+    order = np.argsort(-scores[ys, xs], kind="stable")
+    return [
+        (float(scores[ys[i], xs[i]]), (int(xs[i]) + offset[0], int(ys[i]) + offset[1]))
+        for i in order
+    ]
+
+
+def box_iou(a: Box, b: Box) -> float:
+    width = min(a[2], b[2]) - max(a[0], b[0])
+    height = min(a[3], b[3]) - max(a[1], b[1])
+    if width <= 0 or height <= 0:
+        return 0.0
+    inter = width * height
+    union = (a[2] - a[0]) * (a[3] - a[1]) + (b[2] - b[0]) * (b[3] - b[1]) - inter
+    return inter / float(union)
+
+
+def non_max_suppression(
+    boxes: List[Box], scores: List[float], iou: float, limit: int = 0
+) -> List[int]:
+    # Greedy NMS: indices of kept boxes, strongest first; ties keep the earlier box.
+    kept: List[int] = []
+    for index in sorted(range(len(boxes)), key=lambda i: -scores[i]):
+        if all(box_iou(boxes[index], boxes[other]) <= iou for other in kept):
+            kept.append(index)
+            if limit and len(kept) >= limit:
+                break
+    return kept
+
+
+class PyramidSearch:
+    def __init__(
+        self,
+        levels: int = 2,
+        reject_margin: float = 0.25,
+        candidates: int = 3,
+        min_template_size: int = 8,
+        min_fidelity: float = 0.9,
+    ):
+        self.levels = max(1, int(levels))
+        self.reject_margin = max(0.0, float(reject_margin))
+        self.candidates = max(1, int(candidates))
+        self.min_template_size = max(1, int(min_template_size))
+        self.min_fidelity = float(min_fidelity)
+        self.verified = 0
+        self.rejected = 0
+        self.fallbacks = 0
+        self.full = 0
+        self._lock = threading.Lock()
+
+    def frame_levels(self, image: np.ndarray) -> List[np.ndarray]:
+        levels = [image]
+        for _ in range(self.levels):
+            levels.append(halve(levels[-1]))
+        return levels
+
+    def _count(self, name: str) -> None:
+        with self._lock:
+            setattr(self, name, getattr(self, name) + 1)
+
+    @staticmethod
+    def fidelity(template: np.ndarray, level: int) -> float:
+        # How well the template survives downsampling: correlation between it and its coarse
+        # copy scaled back up. Fine text or dithering averages away, and a true match then
+        # scores far lower at the coarse level than at full resolution.
+        def build() -> np.ndarray:
+            coarse = halve(template, level)
+            restored = cv2.resize(
+                coarse, (template.shape[1], template.shape[0]), interpolation=cv2.INTER_LINEAR
+            )
+            score = cv2.matchTemplate(template, restored, cv2.TM_CCOEFF_NORMED)[0, 0]
+            return np.array(score if np.isfinite(score) else 0.0, dtype=np.float32)
+
+        return float(derived_template(template, ("pyramid_fidelity", level), build))
+
+    def _usable_level(self, template: np.ndarray, levels: List[np.ndarray]) -> int:
+        # The coarsest level whose template is large enough and detailed enough that a low
+        # coarse score really means absence; level 0 means a plain full-resolution search.
+        level = len(levels) - 1
+        while level > 0 and (
+            min(template.shape[:2]) >> level < self.min_template_size
+            or self.fidelity(template, level) < self.min_fidelity
+        ):
+            level -= 1
+        return level
+
+    def search(
+        self, levels: List[np.ndarray], template: np.ndarray, threshold: float
+    ) -> SearchResult:
+        image = levels[0]
+        level = self._usable_level(template, levels)
+        if level == 0:
+            self._count("full")
+            return match_full(image, template)
+        coarse_template = derived_template(
+            template, ("pyramid", level), lambda: halve(template, level)
+        )
+        coarse = levels[level]
+        if (
+            coarse.shape[0] < coarse_template.shape[0]
+            or coarse.shape[1] < coarse_template.shape[1]
+        ):
+            self._count("full")
+            return match_full(image, template)
+
+        factor = 1 << level
+        result = cv2.matchTemplate(coarse, coarse_template, cv2.TM_CCOEFF_NORMED)
+        radius = (max(1, coarse_template.shape[1] // 2), max(1, coarse_template.shape[0] // 2))
+        peaks = _peaks(result, self.candidates, radius)
+        floor = threshold - self.reject_margin
+        if not peaks or peaks[0][0] < floor:
+            # Far below threshold even at the coarse level: nothing to verify.
+            self._count("rejected")
+            if not peaks:
+                return float("-inf"), (0, 0)
+            score, (cx, cy) = peaks[0]
+            return score, (cx * factor, cy * factor)
+
+        # Verify each strong coarse peak in a small full-resolution window around it.
+        height, width = template.shape[:2]
+        pad = 2 * factor
+        best: SearchResult = (float("-inf"), (0, 0))
+        for score, (cx, cy) in peaks:
+            if score < floor:
+                break
+            x0 = max(0, cx * factor - pad)
+            y0 = max(0, cy * factor - pad)
+            x1 = min(image.shape[1], cx * factor + width + pad)
+            y1 = min(image.shape[0], cy * factor + height + pad)
+            if y1 - y0 < height or x1 - x0 < width:
+                continue
+            value, (x, y) = match_full(image[y0:y1, x0:x1], template)
+            if value > best[0]:
+                best = (value, (x0 + x, y0 + y))
+        if best[0] >= threshold:
+            self._count("verified")
+            return best
+        # Ambiguous: the coarse level saw something that did not verify, so scan everything.
+        self._count("fallbacks")
+        return match_full(image, template)
+
+    def stats(self) -> Dict[str, int]:
+        with self._lock:
+            return {
+                "verified": self.verified,
+                "rejected": self.rejected,
+                "fallbacks": self.fallbacks,
+                "full": self.full,
+            }
+
+
+def load_meta(path: str) -> Dict[str, Any]:
+    if not os.path.exists(path):
+        return {}
+    try:
+        with open(path, "r", encoding="utf-8") as f:
+            data = json.load(f)
+        if isinstance(data, dict):
+            return data
+    except Exception:
+        return {}
+    return {}
+
+
+def _meta_pair(meta: Dict[str, Any], key: str) -> Optional[Tuple[float, float]]:
+    value = meta.get(key)
+    if not isinstance(value, (list, tuple)) or len(value) != 2:
+        return None
+    try:
+        x, y = float(value[0]), float(value[1])
+    except (TypeError, ValueError):
+        return None
+    return (x, y) if x > 0 and y > 0 else None
+
+
+def expected_scale(meta: Dict[str, Any], current_scale: Tuple[float, float]) -> float:
+    # Templates captured at another DPI scale show up resized by the ratio of the scales.
+    captured = _meta_pair(meta, "dpi_scale")
+    if not captured:
+        return 1.0
+    return (current_scale[0] / captured[0] + current_scale[1] / captured[1]) / 2.0
+
+
+def resize_by(image: np.ndarray, scale: float) -> np.ndarray:
+    size = (
+        max(1, int(round(image.shape[1] * scale))),
+        max(1, int(round(image.shape[0] * scale))),
+    )
+    interpolation = cv2.INTER_AREA if scale < 1.0 else cv2.INTER_LINEAR
+    return cv2.resize(image, size, interpolation=interpolation)
+
+
+def scale_template(template: np.ndarray, scale: float) -> np.ndarray:
+    if abs(scale - 1.0) < 1e-3:
+        return template
+    return derived_template(
+        template, ("scale", round(scale, 3)), lambda: resize_by(template, scale)
+    )
+
+
+COLOR_MODES = ("bgr", "gray", "b", "g", "r")
+
+
+def check_match_mode(color_mode: str, scale: float) -> Tuple[str, float]:
+    color_mode = str(color_mode).lower()
+    if color_mode not in COLOR_MODES:
+        raise ValueError(f"color_mode must be one of {', '.join(COLOR_MODES)}: {color_mode}")
+    scale = float(scale)
+    if not 0.0 < scale <= 1.0:
+        raise ValueError(f"scale must be in (0, 1]: {scale}")
+    return color_mode, scale
+
+
+def convert_image(image: np.ndarray, color_mode: str = "bgr", scale: float = 1.0) -> np.ndarray:
+    # Matching input for a color mode at reduced resolution; used for frames and templates.
+    if image.ndim == 3 and color_mode == "gray":
+        image = cv2.cvtColor(image, cv2.COLOR_BGR2GRAY)
+    elif image.ndim == 3 and color_mode in ("b", "g", "r"):
+        image = np.ascontiguousarray(image[:, :, "bgr".index(color_mode)])
+    return resize_by(image, scale) if scale < 1.0 else image
+
+
+def prepare_template(template: np.ndarray, color_mode: str, scale: float) -> np.ndarray:
+    if color_mode == "bgr" and scale >= 1.0:
+        return template
+    return derived_template(
+        template,
+        ("mode", color_mode, round(scale, 3)),
+        lambda: convert_image(template, color_mode, scale),
+    )
+
+
+DEFAULT_SCALES = (1.0, 1.25, 0.8, 1.5, 0.667, 1.75, 2.0, 0.5)
+
+
+class ScaleBank:
+    def __init__(self, scales: Tuple[float, ...] = DEFAULT_SCALES, max_candidates: int = 3):
+        self.scales = tuple(float(scale) for scale in scales if scale > 0)
+        self.max_candidates = max(1, int(max_candidates))
+        self.current_scale = (1.0, 1.0)
+        self.winners: Dict[str, float] = {}
+        self.tried = 0
+        self.searches = 0
+        self._lock = threading.Lock()
+
+    def set_current_scale(self, scale_x: float, scale_y: float) -> None:
+        self.current_scale = (float(scale_x), float(scale_y))
+
+    def candidates(self, name: str, meta: Dict[str, Any]) -> List[float]:
+        # Last winner first, then the metadata estimate, then the bank nearest to it, capped at
+        # max_candidates. A template whose recorded dpi_scale matches the current monitor is
+        # only searched as captured (or at its last winning scale).
+        expected = expected_scale(meta, self.current_scale)
+        ordered = [self.winners.get(name, expected), expected]
+        if _meta_pair(meta, "dpi_scale") is None or abs(expected - 1.0) > 1e-3:
+            ordered += sorted(self.scales, key=lambda scale: abs(scale / expected - 1.0))
+        result: List[float] = []
+        for scale in ordered:
+            if all(abs(scale - seen) > 1e-3 for seen in result):
+                result.append(scale)
+        return result[: self.max_candidates]
+
+    def search(
+        self,
+        name: str,
+        meta: Dict[str, Any],
+        frame: "FrameSearch",
+        template: np.ndarray,
+        threshold: float,
+        prepare: Optional[Callable[[np.ndarray], np.ndarray]] = None,
+    ) -> ScaledResult:
+        # `prepare` converts each rescaled variant to the frame's matching mode; the result
+        # still carries the unconverted variant.
+        best: ScaledResult = (float("-inf"), (0, 0), template)
+        tried = 0
+        for scale in self.candidates(name, meta):
+            scaled = scale_template(template, scale)
+            probe = prepare(scaled) if prepare else scaled
+            if not frame.fits(probe):
+                continue
+            tried += 1
+            score, location = frame.search(probe, threshold)
+            if score > best[0]:
+                best = (score, location, scaled)
+            if score >= threshold:
+                with self._lock:
+                    self.winners[name] = scale
+                break
+        with self._lock:
+            self.searches += 1
+            self.tried += tried
+        return best
+
+    def stats(self) -> Dict[str, Any]:
+        with self._lock:
+            return {
+                "searches": self.searches,
+                "avg_scales_tried": self.tried / float(self.searches) if self.searches else 0.0,
+                "winners": dict(self.winners),
+            }
+
+
+class LocationTracker:
+    def __init__(self, margin: float = 1.0, rescan_interval: int = 30):
+        self.margin = max(0.0, float(margin))
+        self.rescan_interval = max(1, int(rescan_interval))
+        self.frame_origin = (0, 0)
+        self._boxes: Dict[str, Box] = {}
+        self._since_full: Dict[str, int] = {}
+        self._tries: Dict[str, int] = {}
+        self._hits: Dict[str, int] = {}
+        self._full_scans: Dict[str, int] = {}
+        self._lock = threading.Lock()
+
+    def set_frame_origin(self, x: int, y: int) -> None:
+        # Screen position of the frame's top-left corner, used to place metadata priors.
+        self.frame_origin = (int(x), int(y))
+
+    def prior(self, name: str, meta: Dict[str, Any]) -> Optional[Box]:
+        box = self._boxes.get(name)
+        if box is not None:
+            return box
+        region = meta.get("capture_region")
+        if isinstance(region, (list, tuple)) and len(region) == 4:
+            x, y, w, h = (int(v) for v in region)
+            return x - self.frame_origin[0], y - self.frame_origin[1], w, h
+        return None
+
+    def _window(self, box: Box, image: np.ndarray) -> Box:
+        x, y, w, h = box
+        pad = int(round(self.margin * max(w, h)))
+        x0 = min(max(0, x - pad), image.shape[1])
+        y0 = min(max(0, y - pad), image.shape[0])
+        x1 = max(x0, min(image.shape[1], x + w + pad))
+        y1 = max(y0, min(image.shape[0], y + h + pad))
+        return x0, y0, x1, y1
+
+    def search(
+        self,
+        name: str,
+        meta: Dict[str, Any],
+        image: np.ndarray,
+        template: np.ndarray,
+        threshold: float,
+        run: Callable[[np.ndarray, bool], Optional[ScaledResult]],
+    ) -> Optional[ScaledResult]:
+        # `run(image, windowed)` performs the actual search on the given image.
+        box = self.prior(name, meta)
+        with self._lock:
+            since_full = self._since_full.get(name, 0)
+        if box is not None and since_full < self.rescan_interval:
+            x0, y0, x1, y1 = self._window(box, image)
+            window = image[y0:y1, x0:x1]
+            found = None
+            if window.shape[0] >= template.shape[0] and window.shape[1] >= template.shape[1]:
+                found = run(window, True)
+            with self._lock:
+                self._tries[name] = self._tries.get(name, 0) + 1
+                if found is not None and found[0] >= threshold:
+                    self._hits[name] = self._hits.get(name, 0) + 1
+                    self._since_full[name] = since_full + 1
+                    score, (x, y), scaled = found
+                    found = score, (x0 + x, y0 + y), scaled
+                    self._boxes[name] = (x0 + x, y0 + y, scaled.shape[1], scaled.shape[0])
+                    return found
+
+        found = run(image, False)
+        with self._lock:
+            self._since_full[name] = 0
+            self._full_scans[name] = self._full_scans.get(name, 0) + 1
+            if found is not None and found[0] >= threshold:
+                score, (x, y), scaled = found
+                self._boxes[name] = (x, y, scaled.shape[1], scaled.shape[0])
+            else:
+                self._boxes.pop(name, None)
+        return found
+
+    def stats(self) -> Dict[str, Dict[str, float]]:
+        with self._lock:
+            names = set(self._tries) | set(self._full_scans)
+            return {
+                name: {
+                    "prior_tries": self._tries.get(name, 0),
+                    "prior_hits": self._hits.get(name, 0),
+                    "prior_hit_rate": (
+                        self._hits.get(name, 0) / float(self._tries[name])
+                        if self._tries.get(name)
+                        else 0.0
+                    ),
+                    "full_scans": self._full_scans.get(name, 0),
+                }
+                for name in sorted(names)
+            }
+
+
+class StatsPrefilter:
+    # Rejects window positions that TM_CCOEFF_NORMED cannot score above zero. The score ignores
+    # brightness and contrast, so no bound on the window mean is valid; a window with no
+    # variance, though, scores exactly 0 against any template. Solid panels and backgrounds
+    # are common in UI frames, so that still leaves out much of the frame. The remaining
+    # positions are grouped into a few crops; when those would cover most of the frame anyway,
+    # the frame is searched whole.
+    def __init__(self, cell: int = 32, max_coverage: float = 0.7):
+        self.cell = max(1, int(cell))
+        self.max_coverage = float(max_coverage)
+        self.checked = 0
+        self.rejected = 0
+        self.positions = 0
+        self.kept = 0
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def integrals(image: np.ndarray) -> Tuple[np.ndarray, np.ndarray]:
+        # One cv2.integral2 pass per frame: per-channel sums and channel-summed square sums.
+        # Both hold exact integers for 8-bit images, so flat windows are found exactly.
+        sums, squares = cv2.integral2(image, sdepth=cv2.CV_64F, sqdepth=cv2.CV_64F)
+        if squares.ndim == 3:
+            squares = squares.sum(axis=2)
+        return sums, squares
+
+    @staticmethod
+    def textured(integrals: Tuple[np.ndarray, np.ndarray], size: Tuple[int, int]) -> np.ndarray:
+        # 1 at every top-left (x, y) whose h x w window is not flat, i.e. where
+        # count * sum(x^2) - sum(x)^2 (summed over channels) is non-zero.
+        sums, squares = integrals
+        h, w = size
+
+        def window(table: np.ndarray) -> np.ndarray:
+            return table[h:, w:] - table[:-h, w:] - table[h:, :-w] + table[:-h, :-w]
+
+        totals = window(sums)
+        if totals.ndim == 3:
+            spread = np.einsum("ijk,ijk->ij", totals, totals)
+        else:
+            spread = totals * totals
+        return (float(h * w) * window(squares) - spread > 0.5).view(np.uint8)
+
+    @staticmethod
+    def is_flat(template: np.ndarray) -> bool:
+        def build() -> np.ndarray:
+            _, std = cv2.meanStdDev(template)
+            return np.array(bool(np.all(std == 0)))
+
+        return bool(derived_template(template, ("flat",), build))
+
+    def regions(self, textured: np.ndarray, template: np.ndarray) -> Optional[List[Box]]:
+        # Image boxes (x0, y0, x1, y1) that hold every non-flat window, or None when there is
+        # none. A flat template scores 1.0 everywhere, so nothing can be ruled out for it.
+        height, width = template.shape[:2]
+        rows, cols = textured.shape
+        full = [(0, 0, cols - 1 + width, rows - 1 + height)]
+        if self.is_flat(template):
+            kept = textured.size
+            boxes: Optional[List[Box]] = full
+        else:
+            kept = cv2.countNonZero(textured)
+            boxes = self._group(textured, width, height) if kept else None
+        with self._lock:
+            self.checked += 1
+            self.positions += textured.size
+            self.kept += kept
+            if boxes is None:
+                self.rejected += 1
+        if boxes is None:
+            return None
+        area = sum((x1 - x0) * (y1 - y0) for x0, y0, x1, y1 in boxes)
+        if area >= self.max_coverage * (cols - 1 + width) * (rows - 1 + height):
+            return full
+        return boxes
+
+    def _group(self, textured: np.ndarray, width: int, height: int) -> List[Box]:
+        # Connected blocks of cell x cell positions, each shrunk to the positions it keeps.
+        cell = self.cell
+        rows, cols = textured.shape
+        grid_rows, grid_cols = -(-rows // cell), -(-cols // cell)
+        padded = np.zeros((grid_rows * cell, grid_cols * cell), dtype=np.uint8)
+        padded[:rows, :cols] = textured
+        grid = padded.reshape(grid_rows, cell, grid_cols, cell).max(axis=(1, 3))
+        count, _, blocks, _ = cv2.connectedComponentsWithStats(grid, connectivity=8)
+        boxes = []
+        for bx, by, bw, bh, _ in blocks[1:count]:
+            x0, y0 = bx * cell, by * cell
+            x1, y1 = min(cols, (bx + bw) * cell), min(rows, (by + bh) * cell)
+            x, y, w, h = cv2.boundingRect(textured[y0:y1, x0:x1])
+            boxes.append((x0 + x, y0 + y, x0 + x + w - 1 + width, y0 + y + h - 1 + height))
+        return boxes
+
+    def stats(self) -> Dict[str, float]:
+        with self._lock:
+            return {
+                "checked": self.checked,
+                "rejected": self.rejected,
+                "rejection_rate": self.rejected / float(self.checked) if self.checked else 0.0,
+                "position_rejection_rate": (
+                    1.0 - self.kept / float(self.positions) if self.positions else 0.0
+                ),
+            }
+
+
+class FrameSearch:
+    # Per-frame products (pyramid levels, window variances) shared by every template searched.
+    def __init__(
+        self,
+        image: np.ndarray,
+        pyramid: Optional[PyramidSearch] = None,
+        prefilter: Optional[StatsPrefilter] = None,
+    ):
+        self.image = image
+        self.pyramid = pyramid
+        self.prefilter = prefilter
+        self._products: Dict[Any, Any] = {}
+        self._lock = threading.Lock()
+
+    def shared(self, key: Any, build: Callable[[], T]) -> T:
+        with self._lock:
+            if key in self._products:
+                return self._products[key]
+        product = build()
+        with self._lock:
+            return self._products.setdefault(key, product)
+
+    def fits(self, template: np.ndarray) -> bool:
+        return (
+            template.shape[0] <= self.image.shape[0] and template.shape[1] <= self.image.shape[1]
+        )
+
+    def levels(self) -> List[np.ndarray]:
+        return self.shared(("levels",), lambda: self.pyramid.frame_levels(self.image))
+
+    def regions(self, template: np.ndarray) -> Optional[List[Box]]:
+        # Prefilter crops for this template; the integral images are built once per frame.
+        size = template.shape[:2]
+        integrals = self.shared(("integrals",), lambda: StatsPrefilter.integrals(self.image))
+        textured = self.shared(
+            ("textured", size), lambda: StatsPrefilter.textured(integrals, size)
+        )
+        return self.prefilter.regions(textured, template)
+
+    def score_map(self, template: np.ndarray) -> Optional[Tuple[np.ndarray, Location]]:
+        # Full correlation map (and its offset in the frame) for extracting every instance;
+        # the prefilter still narrows it, the pyramid does not apply.
+        if not self.prefilter:
+            return cv2.matchTemplate(self.image, template, cv2.TM_CCOEFF_NORMED), (0, 0)
+        boxes = self.regions(template)
+        if boxes is None:
+            return None
+        height, width = template.shape[:2]
+        # Skipped windows are flat, where matchTemplate itself scores 0.
+        scores = np.zeros(
+            (self.image.shape[0] - height + 1, self.image.shape[1] - width + 1), dtype=np.float32
+        )
+        for x0, y0, x1, y1 in boxes:
+            scores[y0 : y1 - height + 1, x0 : x1 - width + 1] = cv2.matchTemplate(
+                self.image[y0:y1, x0:x1], template, cv2.TM_CCOEFF_NORMED
+            )
+        return scores, (0, 0)
+
+    def search(self, template: np.ndarray, threshold: float) -> SearchResult:
+        boxes = self.regions(template) if self.prefilter else None
+        if self.prefilter and boxes is None:
+            return float("-inf"), (0, 0)
+        if boxes is None or boxes == [(0, 0, self.image.shape[1], self.image.shape[0])]:
+            if self.pyramid:
+                return self.pyramid.search(self.levels(), template, threshold)
+            return match_full(self.image, template)
+        best: SearchResult = (float("-inf"), (0, 0))
+        for x0, y0, x1, y1 in boxes:
+            crop = self.image[y0:y1, x0:x1]
+            if self.pyramid:
+                score, (x, y) = self.pyramid.search(
+                    self.pyramid.frame_levels(crop), template, threshold
+                )
+            else:
+                score, (x, y) = match_full(crop, template)
+            # Ties go to the earlier position in raster order, as in one full-frame search.
+            if score > best[0] or (score == best[0] and (y0 + y, x0 + x) < best[1][::-1]):
+                best = score, (x0 + x, y0 + y)
+        return best
+
+
+class FftCorrelator:
+    # TM_CCOEFF_NORMED for many same-size templates at once: the frame spectrum and the window
+    # energies are computed once per frame, after which each template costs one spectrum product
+    # and one inverse FFT (channels are summed before the inverse). Scores agree with
+    # cv2.matchTemplate to within FFT_TOLERANCE. Template spectra are frame-sized, so they
+    # are kept in an LRU bounded by `cache_mb` and recomputed once evicted.
+    FFT_TOLERANCE = 5e-4
+
+    def __init__(self, min_group: int = 2, cache_mb: float = 256.0):
+        self.min_group = max(1, int(min_group))
+        self.cache_mb = max(0.0, float(cache_mb))
+        self.groups = 0
+        self.templates = 0
+        self.spectra_built = 0
+        self.cache_bytes = 0
+        self._spectra: "OrderedDict[Tuple[int, Tuple[int, int]], Tuple[Any, np.ndarray]]" = (
+            OrderedDict()
+        )
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def _planes(image: np.ndarray) -> np.ndarray:
+        planes = image[:, :, None] if image.ndim == 2 else image
+        return np.moveaxis(planes, 2, 0).astype(np.float32)
+
+    def _spectrum(self, search: FrameSearch) -> Tuple[Tuple[int, int], np.ndarray]:
+        def build() -> Tuple[Tuple[int, int], np.ndarray]:
+            height, width = search.image.shape[:2]
+            shape = (cv2.getOptimalDFTSize(height), cv2.getOptimalDFTSize(width))
+            return shape, np.fft.rfft2(self._planes(search.image), s=shape)
+
+        return search.shared(("fft",), build)
+
+    @staticmethod
+    def _window_norms(search: FrameSearch, size: Tuple[int, int]) -> np.ndarray:
+        # Root of each window's squared deviation from its own mean, summed over channels.
+        def build() -> np.ndarray:
+            h, w = size
+            sums, squares = cv2.integral2(search.image, sdepth=cv2.CV_64F, sqdepth=cv2.CV_64F)
+            if sums.ndim == 2:
+                sums, squares = sums[:, :, None], squares[:, :, None]
+
+            def box(table: np.ndarray) -> np.ndarray:
+                return table[h:, w:] - table[:-h, w:] - table[h:, :-w] + table[:-h, :-w]
+
+            s1 = box(sums)
+            energy = np.maximum(box(squares) - s1 * s1 / float(h * w), 0.0).sum(axis=2)
+            return np.sqrt(energy).astype(np.float32)
+
+        return search.shared(("fft_norms", size), build)
+
+    def _template_spectrum(self, template: np.ndarray, shape: Tuple[int, int]) -> np.ndarray:
+        # Conjugate spectrum of the zero-mean template scaled to unit energy.
+        key = (id(template), shape)
+        with self._lock:
+            entry = self._spectra.get(key)
+            if entry is not None and entry[0]() is template:
+                self._spectra.move_to_end(key)
+                return entry[1]
+        planes = self._planes(template)
+        planes -= planes.mean(axis=(1, 2), keepdims=True)
+        planes /= np.sqrt(np.sum(planes * planes, dtype=np.float64))
+        spectrum = np.conj(np.fft.rfft2(planes, s=shape)).astype(np.complex64)
+        limit = self.cache_mb * 1024 * 1024
+        with self._lock:
+            self.spectra_built += 1
+            stale = self._spectra.pop(key, None)
+            if stale is not None:
+                self.cache_bytes -= stale[1].nbytes
+            if spectrum.nbytes <= limit:
+                self._spectra[key] = (weakref.ref(template), spectrum)
+                self.cache_bytes += spectrum.nbytes
+                while self.cache_bytes > limit:
+                    _, (_, dropped) = self._spectra.popitem(last=False)
+                    self.cache_bytes -= dropped.nbytes
+        return spectrum
+
+    @staticmethod
+    def _flat(template: np.ndarray) -> bool:
+        channels = 1 if template.ndim == 2 else template.shape[2]
+        pixels = template.reshape(-1, channels)
+        return bool((pixels.min(axis=0) == pixels.max(axis=0)).all())
+
+    def correlate(self, search: FrameSearch, templates: List[np.ndarray]) -> Iterator[np.ndarray]:
+        # Yields one score map per template, shaped like cv2.matchTemplate's output.
+        shape, frame_spectrum = self._spectrum(search)
+        h, w = templates[0].shape[:2]
+        rows = search.image.shape[0] - h + 1
+        cols = search.image.shape[1] - w + 1
+        norms = self._window_norms(search, (h, w))
+        with self._lock:
+            self.groups += 1
+            self.templates += len(templates)
+        for template in templates:
+            if self._flat(template):
+                # cv2.matchTemplate scores a flat template 1.0 everywhere.
+                yield np.ones((rows, cols), dtype=np.float32)
+                continue
+            product = (self._template_spectrum(template, shape) * frame_spectrum).sum(axis=0)
+            numerator = np.fft.irfft2(product, s=shape)[:rows, :cols]
+            scores = np.zeros((rows, cols), dtype=np.float32)
+            np.divide(numerator, norms, out=scores, where=norms > 1e-3)
+            yield np.clip(scores, -1.0, 1.0, out=scores)
+
+    def search_group(self, search: FrameSearch, templates: List[np.ndarray]) -> List[SearchResult]:
+        results = []
+        for scores in self.correlate(search, templates):
+            _, max_val, _, max_loc = cv2.minMaxLoc(scores)
+            results.append((float(max_val), (int(max_loc[0]), int(max_loc[1]))))
+        return results
+
+    def stats(self) -> Dict[str, int]:
+        with self._lock:
+            return {
+                "groups": self.groups,
+                "templates": self.templates,
+                "spectra_built": self.spectra_built,
+                "cache_mb": self.cache_bytes / (1024.0 * 1024.0),
+            }
+
+
+class ParallelSearch:
+    # Runs per-template searches on a thread pool; OpenCV releases the GIL while correlating,
+    # so templates are matched concurrently. Once a template scores `stop` or more, templates
+    # after it in list order are cancelled while earlier ones still finish, so the outcome is
+    # the same as a serial loop that breaks at the first such template.
+    def __init__(self, workers: int = 4, certain: Optional[float] = 0.99):
+        self.workers = max(1, int(workers))
+        self.certain = None if certain is None else float(certain)
+        self.runs = 0
+        self.early_exits = 0
+        self.skipped = 0
+        self._latency: Dict[str, Tuple[int, float, float]] = {}
+        self._executor: Optional[ThreadPoolExecutor] = None
+        self._lock = threading.Lock()
+
+    def _timed(
+        self, name: str, search: Callable[[int], Optional[ScaledResult]], index: int
+    ) -> Optional[ScaledResult]:
+        start = time.perf_counter()
+        found = search(index)
+        elapsed = time.perf_counter() - start
+        with self._lock:
+            runs, _, total = self._latency.get(name, (0, 0.0, 0.0))
+            self._latency[name] = (runs + 1, elapsed, total + elapsed)
+        return found
+
+    def _pool(self) -> ThreadPoolExecutor:
+        with self._lock:
+            if self._executor is None:
+                self._executor = ThreadPoolExecutor(
+                    max_workers=self.workers, thread_name_prefix="template-match"
+                )
+            return self._executor
+
+    def run(
+        self,
+        names: List[str],
+        search: Callable[[int], Optional[ScaledResult]],
+        stop: Optional[float] = None,
+    ) -> List[Optional[ScaledResult]]:
+        # Results in list order; None for templates after the first one reaching `stop`.
+        results: List[Optional[ScaledResult]] = [None] * len(names)
+        cutoff = len(names)
+        if self.workers == 1 or len(names) < 2:
+            for index, name in enumerate(names):
+                found = results[index] = self._timed(name, search, index)
+                if stop is not None and found is not None and found[0] >= stop:
+                    cutoff = index
+                    break
+        else:
+            pool = self._pool()
+            futures: Dict[Future, int] = {
+                pool.submit(self._timed, name, search, index): index
+                for index, name in enumerate(names)
+            }
+            by_index = sorted(futures, key=futures.__getitem__)
+            for future in as_completed(futures):
+                index = futures[future]
+                if future.cancelled() or index > cutoff:
+                    continue
+                found = results[index] = future.result()
+                if stop is not None and found is not None and found[0] >= stop:
+                    cutoff = index
+                    for later in by_index[index + 1 :]:
+                        later.cancel()
+            for index in range(cutoff + 1, len(names)):
+                results[index] = None
+        with self._lock:
+            self.runs += 1
+            if cutoff < len(names):
+                self.early_exits += 1
+                self.skipped += len(names) - cutoff - 1
+        return results
+
+    def close(self) -> None:
+        with self._lock:
+            executor, self._executor = self._executor, None
+        if executor is not None:
+            executor.shutdown(wait=False, cancel_futures=True)
+
+    def stats(self) -> Dict[str, Any]:
+        with self._lock:
+            return {
+                "runs": self.runs,
+                "early_exits": self.early_exits,
+                "skipped": self.skipped,
+                "latency_ms": {
+                    name: {
+                        "last": last * 1000.0,
+                        "avg": total / runs * 1000.0,
+                        "runs": runs,
+                    }
+                    for name, (runs, last, total) in sorted(self._latency.items())
+                },
+            }
+
@@ -0,0 +1,25 @@
+from typing import Any, Iterable, Tuple
+
+import pytesseract
+
+
+TextBox = Tuple[str, int, int, int, int, int]
+
+
+def iter_image_text_boxes(
+    image: Any, lang: str, offset: Tuple[int, int] = (0, 0)
+) -> Iterable[TextBox]:
+    data = pytesseract.image_to_data(image, lang=lang, output_type=pytesseract.Output.DICT)
+    for i, text in enumerate(data.get("text", [])):
+        text = (text or "").strip()
+        if not text:
+            continue
+        try:
+            conf = int(float(data.get("conf", [0])[i]))
+        except (ValueError, TypeError):
+            conf = 0
+        x = int(data.get("left", [0])[i]) + offset[0]
+        y = int(data.get("top", [0])[i]) + offset[1]
+        w = int(data.get("width", [0])[i])
+        h = int(data.get("height", [0])[i])
+        yield text, conf, x, y, w, h
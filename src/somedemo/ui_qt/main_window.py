@@ -11,7 +11,14 @@ from PySide6 import QtCore, QtGui, QtWidgets
 from somedemo.action_executor import execute, execute_match
 from somedemo.recorder_core import RecorderCore
 from somedemo.region_selector import select_region
-from somedemo.scene_matcher import load_scene_rules, match_scene
+from somedemo.rules_watcher import RulesWatcher
+from somedemo.scene_matcher import (
+    StatefulSceneMatcher,
+    compile_scene_rules,
+    load_scene_rules,
+    load_scene_transitions,
+    match_scene,
+)
 from somedemo.screen_capture import ScreenCapture
 from somedemo.template_matcher import TemplateMatcher
 from somedemo.template_monitor import capture_program_template, ensure_dpi_aware
@@ -58,6 +65,10 @@ class MainWindow(QtWidgets.QMainWindow):
         self._auto_running = False
         self._auto_paused = False
         self._scene_rules = []
+        self._compiled_scene_rules = None
+        self._scene_state = None
+        self._frame_budget = None
+        self._rules_watcher = None
         self._scene_rules_path = _resource_path(
             os.path.join("assets", "scenes", "sample_rules.json")
         )
@@ -189,6 +200,11 @@ class MainWindow(QtWidgets.QMainWindow):
         self.monitor_fps_spin.setValue(2)
         fps_layout.addWidget(fps_label)
         fps_layout.addWidget(self.monitor_fps_spin)
+        fps_layout.addSpacing(12)
+        # Off by default: budgeted frames report skipped rules by their previous verdict.
+        self.monitor_budget_chk = QtWidgets.QCheckBox("\u6309\u5e27\u7387\u9650\u65f6\u5339\u914d")
+        self.monitor_budget_chk.setChecked(False)
+        fps_layout.addWidget(self.monitor_budget_chk)
         fps_layout.addStretch(1)
         monitor_layout.addLayout(fps_layout)
 
@@ -562,6 +578,7 @@ class MainWindow(QtWidgets.QMainWindow):
         self.template_click_interval.setEnabled(can_edit_templates)
         self.template_random_offset.setEnabled(can_edit_templates)
         self.monitor_fps_spin.setEnabled(can_edit_templates)
+        self.monitor_budget_chk.setEnabled(can_edit_templates)
         self.template_thumb_list.setEnabled(can_edit_templates)
 
     def _append_log(self, message):
@@ -745,6 +762,17 @@ class MainWindow(QtWidgets.QMainWindow):
             return False
         try:
             self._scene_rules = load_scene_rules(self._scene_rules_path)
+            self._compiled_scene_rules = compile_scene_rules(
+                self._scene_rules,
+                base_dir=self._scene_rules_base,
+                log_callback=self._signals.log_signal.emit,
+            )
+            transitions = load_scene_transitions(self._scene_rules_path)
+            self._scene_state = (
+                StatefulSceneMatcher(self._compiled_scene_rules, transitions)
+                if transitions
+                else None
+            )
         except Exception as exc:
             self._signals.log_signal.emit(
                 f"\u573a\u666f\u89c4\u5219\u8bfb\u53d6\u5931\u8d25: {exc}"
@@ -761,6 +789,7 @@ class MainWindow(QtWidgets.QMainWindow):
         self._template_matcher = TemplateMatcher.load_from_paths(
             self._template_paths, threshold=threshold
         )
+        self._template_matcher.enable_tracking(frame_origin=self._auto_region[:2])
         summary = self._template_matcher.describe()
         if summary:
             items = ", ".join(
@@ -877,12 +906,22 @@ class MainWindow(QtWidgets.QMainWindow):
             return
         self._auto_paused = False
         fps = int(self.monitor_fps_spin.value())
+        self._frame_budget = 1.0 / max(1, fps) if self.monitor_budget_chk.isChecked() else None
         self._auto_capture = ScreenCapture(
             region=self._auto_region,
             fps=fps,
             frame_callback=self._on_frame,
         )
         self._capture_debug_logged = False
+        self._rules_watcher = RulesWatcher(
+            self._scene_rules_path if scene_ok else None,
+            base_dir=self._scene_rules_base,
+            compiled=self._compiled_scene_rules if scene_ok else None,
+            template_paths=self._template_paths if template_ok else None,
+            template_threshold=float(self.template_threshold_spin.value()),
+            log_callback=self._signals.log_signal.emit,
+        )
+        self._rules_watcher.start()
         self._auto_capture.start()
         self._auto_running = True
         self._signals.log_signal.emit("\u81ea\u52a8\u76d1\u63a7\u5df2\u5f00\u59cb\u3002")
@@ -903,14 +942,39 @@ class MainWindow(QtWidgets.QMainWindow):
         if self._auto_capture:
             self._auto_capture.stop()
             self._auto_capture = None
+        if self._rules_watcher:
+            self._rules_watcher.stop()
+            self._rules_watcher = None
         self._auto_running = False
         self._auto_paused = False
         self._signals.log_signal.emit("\u81ea\u52a8\u76d1\u63a7\u5df2\u505c\u6b62\u3002")
         self._update_ui_state()
 
+    def _apply_reload(self):
+        watcher = self._rules_watcher
+        reload = watcher.take_pending() if watcher else None
+        if reload is None:
+            return
+        if reload.compiled is not None:
+            previous_state = self._scene_state
+            self._scene_rules = reload.rules
+            self._compiled_scene_rules = reload.compiled
+            self._scene_state = (
+                StatefulSceneMatcher(reload.compiled, reload.transitions)
+                if reload.transitions
+                else None
+            )
+            if self._scene_state and previous_state:
+                self._scene_state.current = previous_state.current
+        if reload.template_matcher is not None:
+            if self._template_matcher:
+                reload.template_matcher.inherit_settings(self._template_matcher)
+            self._template_matcher = reload.template_matcher
+
     def _on_frame(self, frame):
         if not self._auto_running or self._auto_paused:
             return
+        self._apply_reload()
         if not self._capture_debug_logged:
             height, width = frame.shape[:2]
             self._signals.log_signal.emit(
@@ -946,7 +1010,13 @@ class MainWindow(QtWidgets.QMainWindow):
 
                 threading.Thread(target=run_template_action, daemon=True).start()
                 return
-        scene = match_scene(frame, self._scene_rules, base_dir=self._scene_rules_base)
+        if not self._compiled_scene_rules:
+            return
+        deadline = time.perf_counter() + self._frame_budget if self._frame_budget else None
+        if self._scene_state:
+            scene = self._scene_state.match(frame, deadline=deadline)
+        else:
+            scene = match_scene(frame, self._compiled_scene_rules, deadline=deadline)
         if not scene:
             return
         rule = next((r for r in self._scene_rules if r.get("name") == scene), None)
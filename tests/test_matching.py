@@ -0,0 +1,167 @@
+import json
+import os
+import tempfile
+import time
+import unittest
+
+import cv2
+import numpy as np
+
+from somedemo.bundle import build_bundle, read_bundle
+from somedemo.scene_matcher import compile_scene_rules, load_scene_rules
+from somedemo.template_matcher import TemplateMatcher
+from somedemo.template_search import FftCorrelator, FrameSearch, local_peaks
+
+
+def _textured(rng, shape):
+    return cv2.GaussianBlur(rng.integers(0, 256, shape, dtype=np.uint8), (0, 0), 2)
+
+
+def _scores(compiled, image):
+    return {hit.name: hit.score for hit in compiled.evaluate(image)}
+
+
+class TestColorRules(unittest.TestCase):
+    def setUp(self):
+        rng = np.random.default_rng(0)
+        self.image = rng.integers(0, 256, (120, 160, 3), dtype=np.uint8)
+        self.rules = [
+            {"name": "full", "type": "color", "lower": [0, 0, 0], "upper": [127, 255, 200], "ratio": 0.0},
+            {"name": "roi", "type": "color", "region": [10, 20, 80, 40], "lower": [50, 60, 70], "upper": [200, 210, 220], "ratio": 0.0},
+            {"name": "edge", "type": "color", "region": [0, 0, 40, 40], "lower": [255, 0, 0], "upper": [255, 255, 255], "ratio": 0.0},
+        ]
+
+    def test_batched_in_range_matches_mean(self):
+        scores = _scores(compile_scene_rules(self.rules), self.image)
+        for rule in self.rules:
+            x, y, w, h = rule.get("region", [0, 0, 160, 120])
+            roi = self.image[y : y + h, x : x + w]
+            lower = np.array(rule["lower"], dtype=np.uint8)
+            upper = np.array(rule["upper"], dtype=np.uint8)
+            expected = float(np.all((roi >= lower) & (roi <= upper), axis=2).mean())
+            self.assertAlmostEqual(scores[rule["name"]], expected, places=9)
+
+    def test_lut_at_full_precision_matches_range_check(self):
+        rules = self.rules + [
+            {
+                "name": "hsv",
+                "type": "color",
+                "ranges": [
+                    {"space": "hsv", "lower": [20, 50, 50], "upper": [90, 255, 255]},
+                    {"lower": [0, 0, 200], "upper": [80, 80, 255]},
+                ],
+                "ratio": 0.0,
+            }
+        ]
+        expected = _scores(compile_scene_rules(rules), self.image)
+        compiled = compile_scene_rules(rules)
+        compiled.enable_color_lut(bits=8)
+        self.assertEqual(_scores(compiled, self.image), expected)
+
+
+class TestTemplateSearch(unittest.TestCase):
+    def test_fft_scores_within_tolerance(self):
+        rng = np.random.default_rng(2)
+        frame = _textured(rng, (96, 128, 3))
+        templates = [np.ascontiguousarray(frame[y : y + 16, x : x + 16]) for x, y in ((5, 7), (60, 30), (100, 70))]
+        templates.append(np.full((16, 16, 3), 90, dtype=np.uint8))
+        correlator = FftCorrelator()
+        for template, scores in zip(templates, correlator.correlate(FrameSearch(frame), templates)):
+            expected = cv2.matchTemplate(frame, template, cv2.TM_CCOEFF_NORMED)
+            self.assertEqual(scores.shape, expected.shape)
+            self.assertLessEqual(float(np.abs(scores - expected).max()), FftCorrelator.FFT_TOLERANCE)
+
+    def test_plateau_is_one_peak(self):
+        scores = np.zeros((50, 60), dtype=np.float32)
+        scores[10, 10] = 0.9
+        scores[20:23, 30:33] = 0.95
+        self.assertEqual(local_peaks(scores, 0.5, (1, 2)), [(scores[20, 30], (31, 22)), (scores[10, 10], (11, 12))])
+        self.assertEqual(local_peaks(np.ones((40, 40), dtype=np.float32), 0.8), [(1.0, (0, 0))])
+
+    def test_prefilter_never_changes_a_match(self):
+        rng = np.random.default_rng(3)
+        for trial in range(12):
+            frame = np.full((120, 160, 3), int(rng.integers(0, 256)), dtype=np.uint8)
+            y, x = (int(v) for v in rng.integers(0, 80, 2))
+            frame[y : y + 40, x : x + 40] = rng.integers(0, 256, (40, 40, 3))
+            if trial % 2:
+                template = frame[y + 5 : y + 25, x + 5 : x + 30].copy()
+            elif trial % 4:
+                template = rng.integers(0, 256, (12, 12, 3), dtype=np.uint8)
+            else:
+                template = np.full((10, 10, 3), int(frame[0, 0, 0]), dtype=np.uint8)
+            if trial % 3 == 0:
+                frame = cv2.add(frame, 40)
+            plain = TemplateMatcher([{"name": "t", "image": template, "threshold": 0.5}])
+            filtered = TemplateMatcher([{"name": "t", "image": template, "threshold": 0.5}])
+            filtered.enable_prefilter()
+            expected, actual = plain.match(frame), filtered.match(frame)
+            self.assertEqual(expected is None, actual is None, trial)
+            if expected is not None:
+                self.assertAlmostEqual(actual["confidence"], expected["confidence"], places=5)
+                self.assertEqual((actual["x"], actual["y"]), (expected["x"], expected["y"]))
+
+
+class TestBudgetedMatch(unittest.TestCase):
+    def test_deferred_verdict_is_not_the_scene(self):
+        rng = np.random.default_rng(4)
+        frame = _textured(rng, (90, 120, 3))
+        template = frame[20:44, 30:62].copy()
+        compiled = compile_scene_rules([{"name": "menu", "type": "template", "template_image": template, "threshold": 0.9}])
+        self.assertEqual(compiled.match(frame), "menu")
+        # The deadline has already passed, so the rule is deferred and its last verdict is stale.
+        other = _textured(rng, (90, 120, 3))
+        self.assertIsNone(compiled.match(other, deadline=time.perf_counter() - 1.0))
+
+
+class TestBundle(unittest.TestCase):
+    def test_round_trip(self):
+        rng = np.random.default_rng(5)
+        gray = rng.integers(0, 256, (20, 30), dtype=np.uint8)
+        color = rng.integers(0, 256, (16, 24, 3), dtype=np.uint8)
+        with tempfile.TemporaryDirectory() as tmp:
+            cv2.imwrite(os.path.join(tmp, "gray.png"), gray)
+            cv2.imwrite(os.path.join(tmp, "color.png"), color)
+            rules = {
+                "rules": [
+                    {"name": "title", "type": "template", "template": "gray.png", "threshold": 0.8},
+                    {
+                        "name": "both",
+                        "type": "all",
+                        "rules": [
+                            {"type": "template", "template": "color.png"},
+                            {"type": "not", "rule": {"type": "template", "template": "gray.png"}},
+                        ],
+                    },
+                    {"name": "green", "type": "color", "lower": [0, 200, 0], "upper": [80, 255, 80], "ratio": 0.5},
+                ],
+                "transitions": {"title": ["both"]},
+            }
+            templates = {"templates": [{"name": "gray", "path": os.path.join(tmp, "gray.png")}]}
+            rules_path = os.path.join(tmp, "rules.json")
+            templates_path = os.path.join(tmp, "templates.json")
+            with open(rules_path, "w", encoding="utf-8") as f:
+                json.dump(rules, f)
+            with open(templates_path, "w", encoding="utf-8") as f:
+                json.dump(templates, f)
+            bundle_path = os.path.join(tmp, "automation.sdb")
+            build_bundle(bundle_path, rules_path=rules_path, base_dir=tmp, templates_json=templates_path)
+
+            self.assertEqual(read_bundle(bundle_path).transitions(), rules["transitions"])
+            loaded = load_scene_rules(bundle_path)
+            self.assertEqual([rule.get("name") for rule in loaded], ["title", "both", "green"])
+            np.testing.assert_array_equal(loaded[0]["template_image"], gray)
+            np.testing.assert_array_equal(loaded[1]["rules"][0]["template_image"], color)
+            np.testing.assert_array_equal(loaded[1]["rules"][1]["rule"]["template_image"], gray)
+
+            matcher = TemplateMatcher.load_from_json(bundle_path)
+            np.testing.assert_array_equal(matcher.templates[0]["image"], cv2.cvtColor(gray, cv2.COLOR_GRAY2BGR))
+            frame = np.zeros((60, 80, 3), dtype=np.uint8)
+            frame[10:30, 20:50] = cv2.cvtColor(gray, cv2.COLOR_GRAY2BGR)
+            hit = matcher.match(frame)
+            self.assertIsNotNone(hit)
+            self.assertEqual((hit["x"], hit["y"]), (20, 10))
+
+
+if __name__ == "__main__":
+    unittest.main()